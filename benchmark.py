@@ -0,0 +1,551 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import asyncio
+import hashlib
+import argparse
+import socket
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from io import BytesIO
+from typing import List, Dict, Tuple
+import aiohttp
+from aiohttp import web
+from PIL import Image
+from rich.console import Console
+from rich.table import Table
+
+import aiofiles
+
+from download_images import (
+    ImageDownloader, DownloadPipeline, PartFileWriter, AiohttpTransport, Http2Transport, CONFIG_FILE,
+    console as downloader_console
+)
+
+console = Console()
+
+# 本地基准测试不经过配置中的代理
+NO_PROXY = {"proxy_pool": "", "proxy_manager": {"proxies": []}}
+
+
+def make_rows(count: int) -> List[tuple]:
+    """生成测试记录（使用唯一前缀，避免与真实数据冲突）"""
+    prefix = f"https://bench.invalid/{uuid.uuid4().hex}"
+    return [(f"{prefix}/{i}.jpg", f"/tmp/{i}.jpg", "completed", None, None, None) for i in range(count)]
+
+
+async def per_row_commit(downloader: ImageDownloader, rows: List[tuple], concurrency: int):
+    """基准：每条记录单独一个事务提交（旧的 save_image_record 写法）"""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def insert(row: tuple):
+        async with sem:
+            await downloader.store.save_records([row])
+
+    await asyncio.gather(*(insert(row) for row in rows))
+
+
+async def batched_writer(downloader: ImageDownloader, rows: List[tuple], concurrency: int):
+    """后台批量写入：多个生产者并发 put，RecordWriter 批量提交"""
+    writer = downloader.create_record_writer(downloader.store.save_records)
+
+    async def produce(part: List[tuple]):
+        for row in part:
+            await writer.put(row)
+
+    await asyncio.gather(*(produce(rows[i::concurrency]) for i in range(concurrency)))
+    await writer.close()
+
+
+async def bench_records(args) -> dict:
+    """对比逐条提交与批量写入的 rows/sec"""
+    results = {}
+    overrides = dict(NO_PROXY)
+    if args.backend:
+        overrides["state_store"] = {"backend": args.backend}
+    downloader = ImageDownloader(args.config, overrides)
+    async with downloader:
+        for name, func in (("per_row_commit", per_row_commit), ("batched_writer", batched_writer)):
+            rows = make_rows(args.rows)
+            start = time.perf_counter()
+            await func(downloader, rows, args.concurrency)
+            elapsed = time.perf_counter() - start
+            await downloader.store.delete_records([row[0] for row in rows])
+            results[name] = {
+                "rows": args.rows,
+                "seconds": round(elapsed, 4),
+                "rows_per_sec": round(args.rows / elapsed, 1)
+            }
+    return results
+
+
+def write_syscalls() -> int:
+    """当前进程累计的 write 类系统调用次数（Linux /proc/self/io），不可用时返回 -1"""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("syscw:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return -1
+
+
+async def aiofiles_writer(path: str, chunks: List[bytes], settings: dict) -> int:
+    """基准：旧写法，每个网络数据块一次 aiofiles 写入"""
+    async with aiofiles.open(path, "wb") as f:
+        for chunk in chunks:
+            await f.write(chunk)
+        if settings["fsync"] == "file":
+            await f.flush()
+            os.fsync(f.fileno())
+    return len(chunks)
+
+
+async def coalescing_writer(path: str, chunks: List[bytes], settings: dict) -> int:
+    """合并写入 + 预分配 + 可选 fsync"""
+    writer = PartFileWriter(
+        path,
+        expected_size=sum(len(chunk) for chunk in chunks),
+        min_chunk=settings["min_chunk"],
+        max_chunk=settings["max_chunk"],
+        preallocate=settings["preallocate"]
+    )
+    await writer.open()
+    for chunk in chunks:
+        await writer.write(chunk)
+    await writer.close(fsync=settings["fsync"] == "file")
+    return writer.writes
+
+
+async def bench_writer(args) -> dict:
+    """对比两种写入方式的吞吐量和每MB写调用次数，都写入 .part 后原子重命名"""
+    settings = ImageDownloader(args.config).config["writer"]
+    if args.fsync:
+        settings["fsync"] = args.fsync
+    body = os.urandom(args.size_kb * 1024)
+    chunks = [body[i:i + args.chunk] for i in range(0, len(body), args.chunk)]
+    total_mb = args.files * len(body) / 1048576
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="imgdl-bench-")
+    try:
+        for name, func in (("aiofiles_8k", aiofiles_writer), ("coalescing", coalescing_writer)):
+            sem = asyncio.Semaphore(args.concurrency)
+            calls = 0
+
+            async def write_file(i: int):
+                nonlocal calls
+                async with sem:
+                    path = os.path.join(workdir, f"{name}-{i}.jpg")
+                    count = await func(path + ".part", chunks, settings)
+                    calls += count
+                    os.replace(path + ".part", path)
+
+            syscalls_before = write_syscalls()
+            started = time.perf_counter()
+            await asyncio.gather(*(write_file(i) for i in range(args.files)))
+            elapsed = time.perf_counter() - started
+            syscalls = write_syscalls() - syscalls_before if syscalls_before >= 0 else -1
+            results[name] = {
+                "files": args.files,
+                "seconds": round(elapsed, 3),
+                "mb_per_sec": round(total_mb / elapsed, 1),
+                "write_calls_per_mb": round(calls / total_mb, 1),
+                "write_syscalls_per_mb": round(syscalls / total_mb, 1) if syscalls >= 0 else "n/a"
+            }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+class ImageServer:
+    """本地测试服务器：生成HTML页面和指定尺寸的 JPEG/PNG/WebP 图片，可注入延迟、错误和429"""
+
+    MIME_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+    def __init__(self, pages: int, images_per_page: int, sizes: List[Tuple[int, int]], formats: List[str],
+                 latency: float = 0.0, error_rate: float = 0.0, throttle_rate: float = 0.0, seed: int = 0):
+        self.pages = pages
+        self.images_per_page = images_per_page
+        self.formats = formats
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.bodies: Dict[Tuple[str, int], bytes] = {}
+        for fmt in formats:
+            for i, size in enumerate(sizes):
+                img = Image.effect_noise(size, 40).convert("RGB")
+                buffer = BytesIO()
+                img.save(buffer, format=fmt.upper(), quality=90)
+                self.bodies[(fmt, i)] = buffer.getvalue()
+        self.sizes = len(sizes)
+        self.bytes_sent = 0
+        self.responses: Dict[int, int] = {}
+        self.runner = None
+        self.base_url = ""
+
+    async def start(self, port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_get("/page/{n}", self.page)
+        app.router.add_get("/img/{name}", self.image)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self.base_url
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def _count(self, status: int):
+        self.responses[status] = self.responses.get(status, 0) + 1
+
+    async def page(self, request: web.Request) -> web.Response:
+        n = int(request.match_info["n"])
+        images = []
+        for i in range(self.images_per_page):
+            fmt = self.formats[(n + i) % len(self.formats)]
+            images.append(f'<img src="/img/{n}-{i}.{fmt}">')
+        link = f'<a href="/page/{n + 1}">next</a>' if n + 1 < self.pages else ""
+        self._count(200)
+        return web.Response(text=f"<html><body>{''.join(images)}{link}</body></html>", content_type="text/html")
+
+    async def image(self, request: web.Request) -> web.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        roll = self.random.random()
+        if roll < self.throttle_rate:
+            self._count(429)
+            return web.Response(status=429, headers={"Retry-After": "1"})
+        if roll < self.throttle_rate + self.error_rate:
+            self._count(500)
+            return web.Response(status=500)
+
+        name = request.match_info["name"]
+        stem, fmt = name.rsplit(".", 1)
+        page, index = (int(x) for x in stem.split("-"))
+        body = self.bodies[(fmt, (page + index) % self.sizes)]
+        # 末尾追加URL哈希，保证每个URL内容不同，避免被内容去重跳过转码
+        body += hashlib.md5(name.encode()).digest()
+        self.bytes_sent += len(body)
+        self._count(200)
+        return web.Response(body=body, content_type=self.MIME_TYPES[fmt])
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+async def bench_throughput(args) -> dict:
+    """启动本地图片服务器，运行完整抓取流程并统计吞吐量和延迟"""
+    sizes = [tuple(int(x) for x in size.split("x")) for size in args.sizes.split(",")]
+    server = ImageServer(
+        args.pages, args.images_per_page, sizes, args.formats.split(","),
+        latency=args.latency / 1000, error_rate=args.error_rate, throttle_rate=args.throttle_rate, seed=args.seed
+    )
+    base_url = await server.start()
+    workdir = tempfile.mkdtemp(prefix="imgdl-bench-")
+    try:
+        # 在构造时传入覆盖项：代理管理器、调度器等组件在构造函数中读取配置
+        overrides = {
+            **NO_PROXY,
+            "state_store": {"backend": "sqlite", "sqlite_path": os.path.join(workdir, "state.db")},
+            "crawl": {"max_depth": args.pages, "max_pages": args.pages, "frontier_file": ""},
+            "content_filter": {"min_size": [0, 0], "max_size": [0, 0]}
+        }
+        if args.threads:
+            overrides["threads"] = args.threads
+        downloader = ImageDownloader(args.config, overrides)
+
+        latencies: List[float] = []
+        fetch_started: Dict[str, float] = {}
+        fetch_image = downloader.fetch_image
+        
+        async def timed_fetch(url: str, folder: str):
+            fetch_started[url] = time.perf_counter()
+            await fetch_image(url, folder)
+        
+        def image_done(url: str):
+            # 流水线在转码完成后才回调，延迟包含下载与转码
+            latencies.append(time.perf_counter() - fetch_started.pop(url))
+        
+        downloader.fetch_image = timed_fetch
+        
+        usage_before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started = time.perf_counter()
+        async with downloader:
+            pipeline = DownloadPipeline(downloader, os.path.join(workdir, "images"), on_done=image_done)
+            pipeline.start()
+            
+            async def enqueue(batch: List[str]):
+                for url in batch:
+                    await pipeline.put(url)
+            
+            try:
+                await downloader.crawl_images(f"{base_url}/page/0", os.path.join(workdir, "images"), sink=enqueue)
+                await pipeline.close()
+            except BaseException:
+                await pipeline.abort()
+                raise
+        elapsed = time.perf_counter() - started
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    finally:
+        await server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    cpu_time = (usage.ru_utime - usage_before.ru_utime + usage.ru_stime - usage_before.ru_stime
+                + children.ru_utime - children_before.ru_utime + children.ru_stime - children_before.ru_stime)
+    return {
+        "throughput": {
+            "images": len(latencies),
+            "seconds": round(elapsed, 3),
+            "images_per_sec": round(len(latencies) / elapsed, 2),
+            "mb_per_sec": round(server.bytes_sent / elapsed / 1048576, 2),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+            "cpu_seconds": round(cpu_time, 3),
+            # Linux 上 ru_maxrss 单位为 KB
+            "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+            "peak_child_rss_mb": round(children.ru_maxrss / 1024, 1),
+            "responses": dict(sorted(server.responses.items()))
+        }
+    }
+
+
+def make_certificate(workdir: str) -> Tuple[str, str]:
+    """用 openssl 生成本地测试用的自签名证书，返回 (证书, 私钥)"""
+    certfile, keyfile = os.path.join(workdir, "cert.pem"), os.path.join(workdir, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+         "-keyout", keyfile, "-out", certfile],
+        check=True, capture_output=True
+    )
+    return certfile, keyfile
+
+
+class H2App:
+    """HTTPS 图片服务（ASGI），/stats 返回按协议统计的客户端连接数，/reset 清零"""
+
+    def __init__(self, body: bytes, latency: float = 0.0):
+        self.body = body
+        self.latency = latency
+        self.connections = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                await send({"type": message["type"] + ".complete"})
+                if message["type"] == "lifespan.shutdown":
+                    return
+        body, content_type = self.body, b"image/jpeg"
+        if scope["path"] == "/stats":
+            stats = {"connections": len(self.connections),
+                     "protocol": ",".join(sorted({version for version, _ in self.connections}))}
+            body, content_type = json.dumps(stats).encode(), b"application/json"
+        elif scope["path"] == "/reset":
+            self.connections.clear()
+            body, content_type = b"{}", b"application/json"
+        else:
+            # 同一连接上的 HTTP/2 流共用客户端地址
+            self.connections.add((scope["http_version"], scope["client"]))
+            if self.latency:
+                await asyncio.sleep(self.latency)
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+def serve_h2(port: int, certfile: str, keyfile: str, body: bytes, latency: float):
+    """在独立进程中运行 hypercorn（ALPN 同时提供 h2 和 http/1.1），服务端开销不计入客户端测量"""
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    config = Config()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.certfile, config.keyfile = certfile, keyfile
+    config.accesslog = None
+    config.errorlog = None
+    # 默认每个连接1000个请求后发送 GOAWAY，测试中不限制
+    config.keep_alive_max_requests = 2 ** 31
+    asyncio.run(serve(H2App(body, latency), config))
+
+
+async def bench_transport(args) -> dict:
+    """对比 HTTP/1.1（aiohttp）与 HTTP/2（httpx）传输层：同一主机大量并发小图片请求的耗时、延迟和打开的连接数"""
+    try:
+        import httpx
+        import h2  # noqa: F401
+        import hypercorn  # noqa: F401
+    except ImportError as e:
+        raise SystemExit(f"transport benchmark needs {e.name}: pip install hypercorn 'httpx[http2]'")
+    settings = ImageDownloader(args.config).config["transport"]
+    body = os.urandom(args.size_kb * 1024)
+    workdir = tempfile.mkdtemp(prefix="imgdl-bench-")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    base_url = f"https://127.0.0.1:{port}"
+    server = multiprocessing.Process(
+        target=serve_h2, args=(port, *make_certificate(workdir), body, args.latency / 1000), daemon=True
+    )
+    server.start()
+    results = {}
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=False)) as control:
+            async def server_call(path: str) -> dict:
+                async with control.get(base_url + path) as response:
+                    return await response.json()
+
+            for _ in range(100):
+                try:
+                    await server_call("/reset")
+                    break
+                except aiohttp.ClientError:
+                    await asyncio.sleep(0.1)
+
+            for name in ("aiohttp", "http2"):
+                await server_call("/reset")
+                # 每种模式都从冷连接开始，计入 TCP+TLS 建连开销
+                session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+                    ssl=False, limit=args.concurrency, limit_per_host=args.concurrency
+                ))
+                transport = AiohttpTransport(session)
+                if name == "http2":
+                    transport = Http2Transport(
+                        settings, fallback=transport, verify=False,
+                        limits=httpx.Limits(max_connections=args.concurrency)
+                    )
+                sem = asyncio.Semaphore(args.concurrency)
+                latencies: List[float] = []
+
+                async def fetch(i: int):
+                    async with sem:
+                        started = time.perf_counter()
+                        async with transport.request("GET", f"{base_url}/img/{i}.jpg") as response:
+                            response.raise_for_status()
+                            async for _ in response.content.iter_chunked(65536):
+                                pass
+                        latencies.append(time.perf_counter() - started)
+
+                usage_before = resource.getrusage(resource.RUSAGE_SELF)
+                started = time.perf_counter()
+                try:
+                    await asyncio.gather(*(fetch(i) for i in range(args.requests)))
+                finally:
+                    elapsed = time.perf_counter() - started
+                    await transport.close()
+                    await session.close()
+                usage = resource.getrusage(resource.RUSAGE_SELF)
+                cpu_time = usage.ru_utime - usage_before.ru_utime + usage.ru_stime - usage_before.ru_stime
+                stats = await server_call("/stats")
+                results[name] = {
+                    "requests": args.requests,
+                    "seconds": round(elapsed, 3),
+                    "requests_per_sec": round(args.requests / elapsed, 1),
+                    "mb_per_sec": round(args.requests * len(body) / elapsed / 1048576, 1),
+                    "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+                    "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+                    "client_cpu_ms_per_request": round(cpu_time / args.requests * 1000, 3),
+                    "connections": stats["connections"],
+                    "protocol": stats["protocol"]
+                }
+    finally:
+        server.terminate()
+        server.join()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def print_results(title: str, results: dict):
+    """每行一个指标，每列一种模式"""
+    table = Table(title=title)
+    table.add_column("metric")
+    for name in results:
+        table.add_column(name, justify="right")
+    for metric in next(iter(results.values())):
+        table.add_row(metric, *(str(values[metric]) for values in results.values()))
+    console.print(table)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="image downloader benchmarks")
+    parser.add_argument("--config", default=CONFIG_FILE, help="配置文件路径")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    parser.add_argument("--output", help="把JSON结果写入文件，便于对比多次运行")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    records = subparsers.add_parser("records", help="数据库记录写入吞吐量")
+    records.add_argument("--rows", type=int, default=5000)
+    records.add_argument("--concurrency", type=int, default=30)
+    records.add_argument("--backend", choices=["mysql", "sqlite"], help="覆盖配置中的存储后端")
+
+    writer = subparsers.add_parser("writer", help="分片文件写入吞吐量与写调用次数")
+    writer.add_argument("--files", type=int, default=200)
+    writer.add_argument("--size-kb", type=int, default=1024)
+    writer.add_argument("--chunk", type=int, default=8192, help="模拟的网络数据块大小")
+    writer.add_argument("--concurrency", type=int, default=30)
+    writer.add_argument("--fsync", choices=["off", "file"], help="覆盖配置中的 fsync 模式")
+
+    throughput = subparsers.add_parser("throughput", help="本地服务器端到端下载吞吐量")
+    throughput.add_argument("--pages", type=int, default=5)
+    throughput.add_argument("--images-per-page", type=int, default=40)
+    throughput.add_argument("--sizes", default="1600x1200,800x600", help="图片尺寸列表，如 1600x1200,800x600")
+    throughput.add_argument("--formats", default="jpeg,png,webp", help="图片格式列表")
+    throughput.add_argument("--latency", type=float, default=0.0, help="每张图片注入的延迟（毫秒）")
+    throughput.add_argument("--error-rate", type=float, default=0.0, help="返回500的比例")
+    throughput.add_argument("--throttle-rate", type=float, default=0.0, help="返回429的比例")
+    throughput.add_argument("--threads", type=int, default=0, help="覆盖配置中的并发数")
+    throughput.add_argument("--seed", type=int, default=0)
+
+    transport = subparsers.add_parser("transport", help="本地 HTTPS 服务器上 HTTP/1.1 与 HTTP/2 传输层对比")
+    transport.add_argument("--requests", type=int, default=2000)
+    transport.add_argument("--size-kb", type=int, default=32)
+    transport.add_argument("--concurrency", type=int, default=32)
+    transport.add_argument("--latency", type=float, default=0.0, help="每个请求注入的服务端延迟（毫秒）")
+
+    args = parser.parse_args()
+    if args.json:
+        # 进度条、阶段耗时表等都改写到标准错误，标准输出只有JSON结果
+        console.file = sys.stderr
+        downloader_console.file = sys.stderr
+    if args.command == "records":
+        results = asyncio.run(bench_records(args))
+    elif args.command == "writer":
+        results = asyncio.run(bench_writer(args))
+    elif args.command == "throughput":
+        results = asyncio.run(bench_throughput(args))
+    elif args.command == "transport":
+        results = asyncio.run(bench_transport(args))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print_results(args.command, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,64 @@
 import os
 import sys
+import csv
+import copy
 import json
 import time
+import re
+import math
+import heapq
 import hashlib
+import random
 import asyncio
+import bisect
+import tarfile
+import argparse
 import aiomysql
 import aiohttp
+import aiofiles
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    import lxml.html
+    from lxml.etree import ParserError
+except ImportError:
+    lxml = None
 from bs4 import BeautifulSoup
 from PIL import Image
 from io import BytesIO
-from urllib.parse import urljoin, urlparse
-from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlparse, urlunparse
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from aiohttp import web
+from yarl import URL
+from multidict import CIMultiDict, CIMultiDictProxy
 from rich.console import Console
-from rich.progress import Progress, BarColumn, DownloadColumn, TimeRemainingColumn
-from typing import List, Dict, Optional, Any, Tuple
+from rich.table import Table
+from rich.progress import Progress, BarColumn, DownloadColumn, TimeRemainingColumn, TextColumn, MofNCompleteColumn
+from rich.logging import RichHandler
+from rich import filesize
+from typing import List, Dict, Optional, Any, Tuple, Callable, Awaitable
+import queue
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
 import datetime
+from collections import deque, defaultdict
 
 console = Console()
+# quiet 模式下 console 不输出，错误仍写到标准错误
+error_console = Console(stderr=True)
+logger = logging.getLogger("image_downloader")
 
 # 配置文件路径
 CONFIG_FILE = "config.json"
@@ -33,202 +73,3540 @@ DEFAULT_CONFIG = {
     "proxy_pool": "https://api.proxyscrape.com/v2/?request=getproxies&protocol=https",
     "proxy_auth": None,
     "proxy_country": "US",
+    "proxy_manager": {
+        "proxies": [],  # 额外的静态代理列表
+        "check_url": "https://www.google.com",
+        "check_timeout": 5,
+        "check_concurrency": 50,
+        "refresh_interval": 600,
+        "retest_interval": 300,
+        "max_failures": 3,
+        "latency_alpha": 0.3,
+        "min_ready": 5,         # 启动时等到这么多代理通过检查即开始下载
+        "startup_timeout": 10   # 启动时最多等待的秒数，其余代理在后台继续检查
+    },
+    
+    "auto_resume": False,
+    "conditional_recrawl": True,
+    "resume": {
+        "checkpoint_bytes": 4194304  # 4MB
+    },
+    
+    "record_writer": {
+        "batch_size": 500,
+        "flush_interval": 1.0,
+        "max_queue": 10000,
+        "max_retries": 3,    # 批量写入失败后的重试次数，仍失败则逐条写入
+        "retry_delay": 0.5   # 首次重试前等待的秒数，之后每次翻倍
+    },
+    
+    "dedup": {
+        "enabled": True,
+        "link": "hardlink"  # hardlink / reference
+    },
+    
+    "crawl": {
+        "max_depth": 1,
+        "max_pages": 1000,
+        "same_domain": True,
+        "allow_domains": [],
+        "frontier_file": "frontier/state.json",
+        "checkpoint_interval": 30,
+        "bloom_capacity": 10000000,
+        "bloom_error_rate": 0.001
+    },
+    
+    "image_compression": {
+        "format": "webp",  # jpeg / png / webp
+        "quality": 85,
+        "lossless": False
+    },
+    
+    # 每张图片额外生成的衍生尺寸（与主输出共用一次解码）；keep_original 时主输出保留原始文件不转码
+    "derivatives": {
+        "keep_original": False,
+        # 例：[{"name": "thumb", "max_size": [320, 320], "format": "webp", "quality": 70}]
+        "sizes": []
+    },
+    
+    "transcode": {
+        "workers": 0,  # 0 表示 CPU 核心数
+        "max_inline_bytes": 33554432,  # 32MB 以内的图片在内存中转码（auto_resume 时仍写 .part 分片以便续传）
+        "max_inflight_bytes": 268435456  # 256MB
+    },
+    
+    "extractor": {
+        "parser": "auto",  # auto / lxml / html.parser
+        "use_processes": False,
+        "workers": 4
+    },
+    
+    "distributed": {
+        "backend": "redis",  # redis / memory（memory 只在单个进程内有效，用于测试）
+        "redis_url": "redis://localhost:6379/0",
+        "queue_name": "image_downloader",
+        "shards": 16,
+        "visibility_timeout": 300,
+        "poll_interval": 1.0
+    },
+    
+    "metrics": {
+        "enabled": True,
+        "port": 0,  # 0 表示不启动 /metrics 端点
+        "summary": True
+    },
+    
+    "scheduler": {
+        "per_host_limit": 6,
+        "dns_cache_ttl": 300,
+        "keepalive_timeout": 30,
+        "adaptive": {
+            "enabled": True,
+            "initial_limit": 2,
+            "min_limit": 1,
+            "decrease_factor": 0.5,
+            "latency_factor": 3.0,
+            "cooldown": 1.0
+        }
+    },
+    
+    # 输出布局：flat / content（按SHA-256前缀分 shard_depth 层目录）/ pack（滚动 tar 包 + 偏移索引）
+    "storage": {
+        "layout": "flat",
+        "shard_depth": 2,
+        "pack_size": 1073741824
+    },
+    
+    # 分片文件写入：合并阈值从 min_chunk 翻倍到 max_chunk；fsync 可选 off / file（每个文件）/ batch（定期批量）
+    "writer": {
+        "min_chunk": 65536,
+        "max_chunk": 4194304,
+        "preallocate": True,
+        "fsync": "off",
+        "fsync_interval": 5
+    },
+    
+    # 传输层：aiohttp（HTTP/1.1）或 http2（需要 httpx[http2]，不支持的主机、代理请求自动回退到 aiohttp）；
+    # http2_prior_knowledge 为 True 时明文 http 也直接使用 HTTP/2（h2c）
+    "transport": {
+        "backend": "aiohttp",
+        "http2_prior_knowledge": False
+    },
+    
+    # 预探测（discover）：sniff_dimensions 为 True 时用小范围 GET 读取头部获取尺寸，否则只发 HEAD（不支持时回退到范围 GET）
+    "discover": {
+        "sniff_dimensions": True
+    },
+    
+    # URL列表导入：按批查询已完成记录，定期保存输入偏移
+    "ingest": {
+        "format": "auto",
+        "csv_column": "url",
+        "batch_size": 500,
+        "checkpoint_file": "frontier/ingest.json",
+        "checkpoint_interval": 30
+    },
+    
+    # 下载流水线的队列长度；transcode_workers 为 0 时与转码进程数相同
+    "pipeline": {
+        "queue_size": 1000,
+        "transcode_queue_size": 64,
+        "transcode_workers": 0
+    },
+    
+    # 单主机熔断：连续失败 failure_threshold 次后在 cooldown 秒内推迟该主机的任务
+    "circuit_breaker": {
+        "enabled": True,
+        "failure_threshold": 5,
+        "cooldown": 30
+    },
+    
+    # 单主机限速，0 表示不限制
+    "rate_limit": {
+        "requests_per_second": 0,
+        "burst": 5,
+        "bytes_per_second": 0,
+        "default_pause": 5,
+        "max_retry_after": 300,
+        "backoff_base": 1,
+        "backoff_max": 30
+    },
+    
+    "state_store": {
+        "backend": "mysql",  # mysql / sqlite
+        "sqlite_path": "image_downloader.db"
+    },
+    
+    "db_config": {
+        "host": "localhost",
+        "port": 3306,
+        "user": "root",
+        "password": "your_password",
+        "db": "image_downloader",
+        "charset": "utf8mb4"
+    },
+    
+    "content_filter": {
+        "min_size": [1200, 800],
+        "max_size": [3840, 2160],  # 0 表示不限制
+        "sniff_bytes": 65536,
+        "content_types": [
+            "image/jpeg",
+            "image/png",
+            "image/webp"
+        ]
+    },
+    
+    # 日志经队列由后台线程写出；逐张图片的结果只进日志文件（DEBUG/INFO），终端显示定时刷新的汇总进度
+    "logging": {
+        "level": "INFO",
+        "console_level": "WARNING",
+        "file": "logs/image_downloader.log",
+        "backup_count": 7,
+        "max_bytes": 10485760,  # 10MB
+        "progress_interval": 0.5,
+        "quiet": False  # 无进度显示和终端输出，只有错误写到标准错误
+    }
+}
+
+class Schema:
+    """简单的配置校验器，支持 type/min/max/gt/lt/len/allowed/nullable/schema 规则（gt/lt 为开区间边界）"""
+    
+    def __init__(self, schema: dict):
+        self.schema = schema
+    
+    def validate(self, config: dict):
+        self._validate_dict(config, self.schema, "")
+    
+    def _validate_dict(self, value: dict, schema: dict, path: str):
+        for key, rule in schema.items():
+            if key not in value:
+                raise ValueError(f"Invalid config: missing '{path}{key}'")
+            self._validate_value(value[key], rule, f"{path}{key}")
+    
+    def _validate_value(self, value, rule: dict, path: str):
+        if value is None:
+            if rule.get("nullable"):
+                return
+            raise ValueError(f"Invalid config: '{path}' must not be null")
+        if not isinstance(value, rule["type"]) or (isinstance(value, bool) and rule["type"] in (int, float)):
+            raise ValueError(f"Invalid config: '{path}' has wrong type {type(value).__name__}")
+        if "min" in rule and value < rule["min"]:
+            raise ValueError(f"Invalid config: '{path}' must be >= {rule['min']}")
+        if "max" in rule and value > rule["max"]:
+            raise ValueError(f"Invalid config: '{path}' must be <= {rule['max']}")
+        if "gt" in rule and value <= rule["gt"]:
+            raise ValueError(f"Invalid config: '{path}' must be > {rule['gt']}")
+        if "lt" in rule and value >= rule["lt"]:
+            raise ValueError(f"Invalid config: '{path}' must be < {rule['lt']}")
+        if "allowed" in rule and value not in rule["allowed"]:
+            raise ValueError(f"Invalid config: '{path}' must be one of {rule['allowed']}")
+        if "len" in rule and len(value) != rule["len"]:
+            raise ValueError(f"Invalid config: '{path}' must have {rule['len']} items")
+        if "schema" in rule:
+            if isinstance(value, dict):
+                self._validate_dict(value, rule["schema"], f"{path}.")
+            else:
+                for i, item in enumerate(value):
+                    self._validate_value(item, rule["schema"], f"{path}[{i}]")
+
+class ContentTypeNotAllowed(Exception):
+    """自定义异常：不允许的内容类型"""
+    pass
+
+class ByteBudget:
+    """在途字节预算：限制内存中等待转码的数据总量，超出时让下载方等待"""
+    
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._cond = asyncio.Condition()
+    
+    async def acquire(self, size: int):
+        size = min(size, self.limit)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+    
+    async def release(self, size: int):
+        size = min(size, self.limit)
+        async with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+    
+    @asynccontextmanager
+    async def reserve(self, size: int):
+        """预留 size 字节，退出时归还；调用 lease.take() 可把归还责任转交给下游"""
+        await self.acquire(size)
+        lease = _BudgetLease(size)
+        try:
+            yield lease
+        finally:
+            if lease.size:
+                await self.release(lease.size)
+
+class _BudgetLease:
+    def __init__(self, size: int):
+        self.size = size
+    
+    def take(self) -> int:
+        size, self.size = self.size, 0
+        return size
+
+def fsync_path(path: str):
+    """把文件（或目录）内容刷到磁盘"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def hash_file_prefix(digest, path: str, length: int):
+    """把文件开头 length 字节计入哈希（在线程池中执行）"""
+    with open(path, "rb") as f:
+        while length > 0:
+            block = f.read(min(length, 1048576))
+            if not block:
+                break
+            digest.update(block)
+            length -= len(block)
+
+class PartFileWriter:
+    """分片文件写入：小数据块在内存中合并后按显式偏移大块写入（线程池中 pwrite），
+    按 Content-Length 预分配空间，可选在关闭时 fsync；完成后由调用方原子重命名为最终文件
+    
+    合并阈值从 min_chunk 开始，每次写入后翻倍直到 max_chunk：小文件很快落盘，大文件的写调用次数少。
+    """
+    
+    def __init__(self, path: str, offset: int = 0, expected_size: int = 0,
+                 min_chunk: int = 65536, max_chunk: int = 4194304, preallocate: bool = True):
+        self.path = path
+        self.position = offset
+        self.expected_size = expected_size
+        self.chunk_size = min_chunk
+        self.max_chunk = max_chunk
+        self.preallocate = preallocate
+        self.writes = 0
+        self._buffer = bytearray()
+        self._fd: Optional[int] = None
+    
+    @property
+    def size(self) -> int:
+        """已接收的总字节数（包括尚未落盘的缓冲）"""
+        return self.position + len(self._buffer)
+    
+    async def open(self):
+        self._fd = await asyncio.get_running_loop().run_in_executor(None, self._open)
+    
+    def _open(self) -> int:
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            # 续传时丢弃偏移之后可能不完整的数据
+            os.ftruncate(fd, self.position)
+            if self.preallocate and self.expected_size > self.position and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, self.position, self.expected_size - self.position)
+                except OSError:
+                    # 文件系统不支持预分配时直接写入
+                    pass
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+    
+    async def write(self, chunk: bytes):
+        self._buffer += chunk
+        if len(self._buffer) >= self.chunk_size:
+            await self.flush()
+    
+    async def flush(self):
+        """把缓冲写入文件"""
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        await asyncio.get_running_loop().run_in_executor(None, self._pwrite, data, self.position)
+        self.position += len(data)
+        self.writes += 1
+        self.chunk_size = min(self.chunk_size * 2, self.max_chunk)
+    
+    def _pwrite(self, data: bytes, offset: int):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self._fd, view, offset)
+            view = view[written:]
+            offset += written
+    
+    async def close(self, fsync: bool = False):
+        """写入剩余数据，截掉预分配但未写入的部分，按需 fsync 后关闭"""
+        if self._fd is None:
+            return
+        try:
+            await self.flush()
+        finally:
+            fd, self._fd = self._fd, None
+            await asyncio.get_running_loop().run_in_executor(None, self._close, fd, fsync)
+    
+    def _close(self, fd: int, fsync: bool):
+        try:
+            if self.preallocate and self.expected_size > self.position:
+                os.ftruncate(fd, self.position)
+            if fsync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+class FsyncBatcher:
+    """批量 fsync：文件先重命名可见，后台定期把一批文件及其目录刷到磁盘，用一次线程切换代替逐个同步"""
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._paths: set = set()
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    def add(self, path: str):
+        self._paths.add(path)
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+    
+    async def flush(self):
+        if not self._paths:
+            return
+        paths, self._paths = self._paths, set()
+        await asyncio.get_running_loop().run_in_executor(None, self._sync, paths)
+    
+    @staticmethod
+    def _sync(paths: set):
+        for path in paths | {os.path.dirname(os.path.abspath(p)) for p in paths}:
+            try:
+                fsync_path(path)
+            except OSError as e:
+                logger.warning("fsync failed: %s: %s", path, e)
+
+FORMAT_EXTENSIONS = {"jpeg": ".jpg", "png": ".png", "webp": ".webp"}
+
+class PackWriter:
+    """滚动 tar 包：文件依次追加到 pack-NNNNN.tar，超过 pack_size 后换新包
+    
+    每个包旁有同名 .idx 索引（JSON Lines：member/url/offset/size），offset 为数据在包内的字节偏移，
+    下游读取任意一张图片只需一次 seek。记录中的路径写作 "<包路径>#<偏移>"。
+    """
+    
+    def __init__(self, folder: str, pack_size: int):
+        self.folder = folder
+        self.pack_size = pack_size
+        self.path: Optional[str] = None
+        self._seq = 0
+        self._tar: Optional[tarfile.TarFile] = None
+        self._index = None
+        self._lock = asyncio.Lock()
+    
+    def _roll(self):
+        """关闭当前包，打开下一个未使用的序号（不追加到上次运行留下的包）"""
+        self._close()
+        os.makedirs(self.folder, exist_ok=True)
+        while os.path.exists(os.path.join(self.folder, f"pack-{self._seq:05d}.tar")):
+            self._seq += 1
+        self.path = os.path.join(self.folder, f"pack-{self._seq:05d}.tar")
+        self._tar = tarfile.open(self.path, "w", format=tarfile.PAX_FORMAT)
+        self._index = open(self.path + ".idx", "a")
+    
+    def _add(self, path: str, member: str, url: str) -> str:
+        if self._tar is None or self._tar.offset >= self.pack_size:
+            self._roll()
+        info = self._tar.gettarinfo(path, arcname=member)
+        with open(path, "rb") as f:
+            self._tar.addfile(info, f)
+        self._tar.fileobj.flush()
+        # 写入后 offset 指向数据块（按 512 字节补齐）之后，倒推数据起始位置
+        offset = self._tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self._index.write(json.dumps({"member": member, "url": url, "offset": offset, "size": info.size}) + "\n")
+        self._index.flush()
+        return f"{self.path}#{offset}"
+    
+    async def add(self, path: str, member: str, url: str) -> str:
+        """把文件追加到当前包，返回包内引用"""
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(None, self._add, path, member, url)
+    
+    def _close(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._index.close()
+            self._tar = self._index = None
+    
+    async def close(self):
+        async with self._lock:
+            self._close()
+
+class Storage:
+    """输出布局：flat 平铺在下载目录；content 按内容哈希前缀分层（ab/cd/<sha256>.ext）；
+    pack 先平铺落盘、完成转码后追加到滚动 tar 包并删除散文件"""
+    
+    def __init__(self, settings: dict):
+        self.layout = settings["layout"]
+        self.shard_depth = settings["shard_depth"]
+        self.pack_size = settings["pack_size"]
+        self._dirs: set = set()
+        self._packs: Dict[str, PackWriter] = {}
+    
+    @property
+    def pack(self) -> bool:
+        return self.layout == "pack"
+    
+    def final_path(self, filepath: str, sha256: str, ext: str) -> str:
+        """下载完成后文件的最终路径；filepath 为按URL命名的平铺路径"""
+        if self.layout != "content":
+            return filepath
+        shards = [sha256[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        directory = os.path.join(os.path.dirname(filepath), *shards)
+        # 已创建的目录只检查一次
+        if directory not in self._dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._dirs.add(directory)
+        return os.path.join(directory, sha256 + ext)
+    
+    async def pack_file(self, path: str, url: str) -> str:
+        """把文件移入所在目录的 packs/ 滚动包，返回包内引用"""
+        folder = os.path.dirname(path)
+        writer = self._packs.get(folder)
+        if writer is None:
+            writer = self._packs[folder] = PackWriter(os.path.join(folder, "packs"), self.pack_size)
+        ref = await writer.add(path, os.path.basename(path), url)
+        os.remove(path)
+        return ref
+    
+    @staticmethod
+    def exists(path: str) -> bool:
+        """文件或包内引用是否存在"""
+        pack_path, sep, offset = path.rpartition("#")
+        if sep and offset.isdigit() and pack_path.endswith(".tar"):
+            return os.path.exists(pack_path)
+        return os.path.exists(path)
+    
+    async def close(self):
+        for writer in self._packs.values():
+            await writer.close()
+
+def derivative_path(out_path: str, name: str, fmt: str) -> str:
+    """衍生图路径：<主文件名>_<名称>.<格式扩展名>"""
+    return f"{os.path.splitext(out_path)[0]}_{name}{FORMAT_EXTENSIONS[fmt]}"
+
+def _save_atomic(img: Image.Image, path: str, fsync: bool, **params):
+    tmp_path = path + ".tmp"
+    try:
+        img.save(tmp_path, **params)
+        if fsync:
+            fsync_path(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def transcode_image(source, out_path: str, fmt: str, quality: int, lossless: bool, fsync: bool = False,
+                    derivatives: Optional[List[dict]] = None, keep_original: bool = False) -> List[tuple]:
+    """解码一次，编码主输出和各衍生尺寸，均写入临时文件后原子替换（在进程池中执行）
+    
+    source 为图片内容（bytes）或已下载的文件路径。衍生图从大到小依次由上一级缩放得到，
+    图片已经不超过某个衍生尺寸时跳过该尺寸（thumbnail 不放大，否则只是重新编码一份同尺寸副本）；
+    keep_original 时主输出保持原始内容，不需要全尺寸像素，JPEG 可以直接按最大衍生尺寸缩小解码（draft）。
+    返回 [(名称, 路径, 宽, 高)]
+    """
+    in_memory = isinstance(source, (bytes, bytearray))
+    specs = sorted(derivatives or [], key=lambda spec: spec["max_size"][0] * spec["max_size"][1], reverse=True)
+    results = []
+    try:
+        if keep_original and in_memory:
+            tmp_path = out_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(source)
+            os.replace(tmp_path, out_path)
+            source = out_path
+            in_memory = False
+        if keep_original and not specs:
+            return results
+        
+        with Image.open(BytesIO(source) if in_memory else source) as img:
+            if keep_original:
+                img.draft("RGB", tuple(specs[0]["max_size"]))
+            base = img.convert("RGB")
+        if not keep_original:
+            _save_atomic(base, out_path, fsync, format=fmt, quality=quality, lossless=lossless)
+        for spec in specs:
+            max_width, max_height = spec["max_size"]
+            if base.width <= max_width and base.height <= max_height:
+                continue
+            derived = base.copy()
+            derived.thumbnail(tuple(spec["max_size"]), Image.LANCZOS, reducing_gap=3.0)
+            path = derivative_path(out_path, spec["name"], spec["format"])
+            _save_atomic(derived, path, fsync, format=spec["format"], quality=spec["quality"])
+            results.append((spec["name"], path, derived.width, derived.height))
+            base = derived
+    except Exception:
+        if in_memory and not os.path.exists(out_path):
+            # 转码失败时保留原始内容
+            with open(out_path, "wb") as f:
+                f.write(source)
+        raise
+    return results
+
+class ImageDimensionRejected(ValueError):
+    """自定义异常：图片像素尺寸超出过滤范围"""
+    pass
+
+class DimensionSniffer:
+    """从数据流开头解析图片头部获取像素尺寸，超出范围时提前中止下载"""
+    
+    def __init__(self, min_size: List[int], max_size: List[int], limit: int):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.limit = limit
+        self.buffer = bytearray()
+        self.done = False
+        self.size: Optional[Tuple[int, int]] = None
+    
+    def feed(self, chunk: bytes):
+        """追加数据并尝试读取尺寸；尺寸不符合时抛出 ImageDimensionRejected"""
+        self.buffer += chunk
+        try:
+            # Image.open 只解析头部，不会像 ImageFile.Parser 那样分配整帧缓冲区
+            with Image.open(BytesIO(self.buffer)) as img:
+                size = img.size
+        except Image.DecompressionBombError:
+            self.done = True
+            raise ImageDimensionRejected("Image too large (decompression bomb)")
+        except Exception:
+            if len(self.buffer) >= self.limit:
+                # 超过嗅探上限仍无法识别，交给后续处理
+                self.done = True
+                self.buffer = bytearray()
+            return
+        self.done = True
+        self.buffer = bytearray()
+        self.size = size
+        self.check(size)
+    
+    def check(self, size: Tuple[int, int]):
+        width, height = size
+        min_w, min_h = self.min_size
+        max_w, max_h = self.max_size
+        if width < min_w or height < min_h:
+            raise ImageDimensionRejected(f"Image too small ({width}x{height})")
+        if (max_w and width > max_w) or (max_h and height > max_h):
+            raise ImageDimensionRejected(f"Image too large ({width}x{height})")
+
+class AimdLimit:
+    """单个主机的 AIMD 并发上限：健康时加性增加，拥塞（429/503、超时、延迟上升）时乘性减少"""
+    
+    def __init__(self, initial: int, minimum: int, maximum: int, decrease_factor: float,
+                 latency_factor: float, cooldown: float):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.successes = 0
+        self.latency: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self.last_decrease = 0.0
+    
+    @property
+    def value(self) -> int:
+        return int(self.limit)
+    
+    def on_success(self, latency: Optional[float]) -> bool:
+        """记录一次成功响应，返回上限是否发生变化"""
+        if latency is not None:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            # 基线取观测到的最低延迟，并缓慢上浮以适应服务器的长期变化
+            self.baseline = latency if self.baseline is None else min(latency, self.baseline * 1.01)
+            if self.latency_factor and self.latency > self.baseline * self.latency_factor:
+                return self.on_congestion()
+        
+        self.successes += 1
+        # 每完成约一个窗口（当前上限个请求）增加 1
+        if self.successes >= self.value and self.limit < self.maximum:
+            self.successes = 0
+            self.limit = min(self.maximum, self.limit + 1)
+            return True
+        return False
+    
+    def on_congestion(self) -> bool:
+        """乘性减少；冷却期内只减少一次，避免同一批在途请求的失败连续砍半"""
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return False
+        self.last_decrease = now
+        self.successes = 0
+        # 延迟均值重新从基线开始统计，否则减少后仍会被旧的高延迟触发
+        self.latency = self.baseline
+        previous = self.value
+        self.limit = max(float(self.minimum), self.limit * self.decrease_factor)
+        return self.value != previous
+
+class HostScheduler:
+    """按主机调度下载槽位：全局并发上限 + 单主机上限，主机间轮询公平分配
+    
+    adaptive 配置启用时，单主机上限由 AIMD 根据响应反馈动态调整，per_host_limit 与全局上限作为天花板。
+    """
+    
+    def __init__(self, global_limit: int, per_host_limit: int, adaptive: Optional[dict] = None):
+        self.global_limit = global_limit
+        self.per_host_limit = per_host_limit
+        self.adaptive = adaptive if adaptive and adaptive["enabled"] else None
+        self._limits: Dict[str, AimdLimit] = {}
+        self._active = 0
+        self._host_active: Dict[str, int] = defaultdict(int)
+        self._waiters: Dict[str, deque] = {}
+        # 有排队任务的主机，按轮询顺序排列
+        self._ring: deque = deque()
+    
+    def host_limit(self, host: str) -> int:
+        """主机当前的并发上限"""
+        if self.adaptive is None:
+            return self.per_host_limit
+        limit = self._limits.get(host)
+        if limit is None:
+            limit = self._limits[host] = AimdLimit(
+                self.adaptive["initial_limit"],
+                self.adaptive["min_limit"],
+                min(self.per_host_limit, self.global_limit),
+                self.adaptive["decrease_factor"],
+                self.adaptive["latency_factor"],
+                self.adaptive["cooldown"]
+            )
+        return limit.value
+    
+    def feedback(self, host: str, ok: bool, latency: Optional[float] = None):
+        """根据请求结果调整主机并发上限；ok=False 表示拥塞信号（429/503、超时）"""
+        if self.adaptive is None:
+            return
+        self.host_limit(host)
+        limit = self._limits[host]
+        if limit.on_success(latency) if ok else limit.on_congestion():
+            # 上限增加后可能有排队任务可以运行
+            self._wakeup()
+    
+    def limits(self) -> Dict[str, int]:
+        return {host: limit.value for host, limit in self._limits.items()}
+    
+    def _has_capacity(self, host: str) -> bool:
+        return self._active < self.global_limit and self._host_active[host] < self.host_limit(host)
+    
+    def _grant(self, host: str):
+        self._active += 1
+        self._host_active[host] += 1
+    
+    async def acquire(self, host: str):
+        """获取指定主机的下载槽位"""
+        if not self._waiters.get(host) and self._has_capacity(host):
+            self._grant(host)
+            return
+        
+        fut = asyncio.get_running_loop().create_future()
+        if host not in self._waiters:
+            self._waiters[host] = deque()
+            self._ring.append(host)
+        self._waiters[host].append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # 已分配槽位但任务被取消，归还槽位
+                self.release(host)
+            else:
+                waiters = self._waiters.get(host)
+                if waiters and fut in waiters:
+                    waiters.remove(fut)
+                    if not waiters:
+                        del self._waiters[host]
+                        self._ring.remove(host)
+            raise
+    
+    def release(self, host: str):
+        """释放槽位并唤醒下一个主机的排队任务"""
+        self._active -= 1
+        self._host_active[host] -= 1
+        if self._host_active[host] <= 0:
+            del self._host_active[host]
+        self._wakeup()
+    
+    def _wakeup(self):
+        """轮询各主机，把空闲槽位分给下一个可运行的排队任务"""
+        idle_rounds = 0
+        while self._ring and self._active < self.global_limit and idle_rounds < len(self._ring):
+            host = self._ring[0]
+            self._ring.rotate(-1)
+            waiters = self._waiters[host]
+            while waiters and waiters[0].done():
+                waiters.popleft()
+            if waiters and self._has_capacity(host):
+                self._grant(host)
+                waiters.popleft().set_result(None)
+                idle_rounds = 0
+            else:
+                idle_rounds += 1
+            if not waiters:
+                del self._waiters[host]
+                self._ring.remove(host)
+    
+    def slot(self, host: str) -> "_HostSlot":
+        """以 async with 方式使用的槽位"""
+        return _HostSlot(self, host)
+
+class _HostSlot:
+    def __init__(self, scheduler: HostScheduler, host: str):
+        self.scheduler = scheduler
+        self.host = host
+    
+    async def __aenter__(self):
+        await self.scheduler.acquire(self.host)
+        return self
+    
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.scheduler.release(self.host)
+
+class HostCircuit:
+    """单个主机的熔断状态"""
+    
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started: Optional[float] = None
+        # 探测结束时触发，唤醒等待探测结果的任务
+        self.probe_done = asyncio.Event()
+
+class CircuitBreaker:
+    """按主机熔断：连续失败 failure_threshold 次后 open，冷却期内的请求立即推迟；
+    冷却结束进入 half_open，只放行一个探测请求（其余请求等待探测结果），成功则 closed，失败重新 open"""
+    
+    def __init__(self, settings: dict):
+        self.enabled = settings["enabled"]
+        self.failure_threshold = settings["failure_threshold"]
+        self.cooldown = settings["cooldown"]
+        self.hosts: Dict[str, HostCircuit] = {}
+        # (时间, 主机, 原状态, 新状态)
+        self.transitions: List[Tuple[float, str, str, str]] = []
+        self.deferred: Dict[str, int] = defaultdict(int)
+    
+    def _circuit(self, host: str) -> HostCircuit:
+        circuit = self.hosts.get(host)
+        if circuit is None:
+            circuit = self.hosts[host] = HostCircuit()
+        return circuit
+    
+    def _transition(self, host: str, circuit: HostCircuit, state: str):
+        self.transitions.append((time.time(), host, circuit.state, state))
+        logger.warning("Circuit %s: %s -> %s", host, circuit.state, state)
+        circuit.state = state
+    
+    async def allow(self, host: str) -> bool:
+        """是否允许向主机发起请求；不允许时调用方应推迟该任务"""
+        if not self.enabled:
+            return True
+        circuit = self._circuit(host)
+        while True:
+            if circuit.state == "closed":
+                return True
+            now = time.monotonic()
+            if circuit.state == "open":
+                if now - circuit.opened_at < self.cooldown:
+                    self.deferred[host] += 1
+                    return False
+                self._transition(host, circuit, "half_open")
+            # half_open：只放行一个探测；探测迟迟没有结果时（任务被取消等）允许重新探测
+            if circuit.probe_started is None or now - circuit.probe_started >= self.cooldown:
+                circuit.probe_started = now
+                circuit.probe_done.clear()
+                return True
+            try:
+                await asyncio.wait_for(circuit.probe_done.wait(), self.cooldown - (now - circuit.probe_started))
+            except asyncio.TimeoutError:
+                pass
+    
+    def record(self, host: str, ok: bool):
+        """报告一次请求结果：ok 表示主机有响应（5xx 除外），失败包括连接错误、超时和 5xx"""
+        if not self.enabled:
+            return
+        circuit = self._circuit(host)
+        circuit.probe_started = None
+        circuit.probe_done.set()
+        if ok:
+            circuit.failures = 0
+            if circuit.state != "closed":
+                self._transition(host, circuit, "closed")
+            return
+        circuit.failures += 1
+        if circuit.state == "half_open" or (circuit.state == "closed" and circuit.failures >= self.failure_threshold):
+            circuit.opened_at = time.monotonic()
+            self._transition(host, circuit, "open")
+    
+    def summary_table(self) -> Optional[Table]:
+        """运行结束时的熔断汇总，没有状态变化时返回 None"""
+        if not self.transitions:
+            return None
+        counts: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        for _, host, _, state in self.transitions:
+            counts[host][state] += 1
+        table = Table(title="Circuit breaker")
+        for column in ("host", "state", "opened", "half-open", "closed", "deferred"):
+            table.add_column(column, justify="left" if column in ("host", "state") else "right")
+        for host, states in sorted(counts.items()):
+            table.add_row(
+                host,
+                self.hosts[host].state,
+                str(states["open"]),
+                str(states["half_open"]),
+                str(states["closed"]),
+                str(self.deferred[host])
+            )
+        return table
+
+class TokenBucket:
+    """令牌桶：允许令牌透支，每个调用方按透支量计算自己的等待时间，多个任务共享时按到达顺序排队"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def reserve(self, amount: float) -> float:
+        """取走 amount 个令牌，返回需要等待的秒数"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class RateLimiter:
+    """按主机限速（请求数/秒、字节/秒），收到 429 或 Retry-After 时暂停整个主机"""
+    
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self._requests: Dict[str, TokenBucket] = {}
+        self._bytes: Dict[str, TokenBucket] = {}
+        self._paused_until: Dict[str, float] = {}
+    
+    def _bucket(self, buckets: Dict[str, TokenBucket], host: str, rate: float, capacity: float) -> TokenBucket:
+        bucket = buckets.get(host)
+        if bucket is None:
+            bucket = buckets[host] = TokenBucket(rate, capacity)
+        return bucket
+    
+    async def wait_paused(self, host: str):
+        """等待主机暂停结束；等待期间暂停可能被延长，需要重新检查"""
+        while True:
+            delay = self._paused_until.get(host, 0.0) - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+    
+    async def acquire(self, host: str):
+        """发起请求前调用"""
+        await self.wait_paused(host)
+        rate = self.settings["requests_per_second"]
+        if rate > 0:
+            bucket = self._bucket(self._requests, host, rate, max(1, self.settings["burst"]))
+            delay = bucket.reserve(1)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                await self.wait_paused(host)
+    
+    async def consume(self, host: str, size: int):
+        """读取响应内容后调用，超出字节速率时等待"""
+        rate = self.settings["bytes_per_second"]
+        if rate > 0:
+            delay = self._bucket(self._bytes, host, rate, rate).reserve(size)
+            if delay > 0:
+                await asyncio.sleep(delay)
+    
+    def pause(self, host: str, seconds: float):
+        """暂停主机上的所有新请求（已有的暂停不会被缩短）"""
+        seconds = min(seconds, self.settings["max_retry_after"])
+        self._paused_until[host] = max(self._paused_until.get(host, 0.0), time.monotonic() + seconds)
+    
+    def throttled(self, host: str, retry_after: Optional[str]):
+        """处理 429/503：按 Retry-After 暂停主机，缺省时使用配置的暂停时间"""
+        seconds = self.parse_retry_after(retry_after)
+        self.pause(host, self.settings["default_pause"] if seconds is None else seconds)
+    
+    @staticmethod
+    def parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """Retry-After 可以是秒数或 HTTP 日期"""
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=datetime.timezone.utc)
+        return max(0.0, (when - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    
+    def backoff(self, attempt: int) -> float:
+        """带完全抖动的指数退避，避免大量任务在同一时刻重试"""
+        ceiling = min(self.settings["backoff_max"], self.settings["backoff_base"] * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+# 视为已完成（磁盘上有可用文件）的记录状态
+DONE_STATUSES = ("completed", "duplicate", "not_modified")
+
+class StateStore:
+    """图片记录存储接口（url -> path/status + HTTP校验器）"""
+    
+    async def open(self):
+        raise NotImplementedError
+    
+    async def close(self):
+        raise NotImplementedError
+    
+    async def save_records(self, rows: List[tuple]):
+        """批量写入 (url, path, status, etag, last_modified, content_length) 记录，每批一个事务
+        
+        path 为空或校验器为 None 时保留已有值
+        """
+        raise NotImplementedError
+    
+    async def delete_records(self, urls: List[str]):
+        raise NotImplementedError
+    
+    async def get_record(self, url: str) -> Optional[dict]:
+        raise NotImplementedError
+    
+    async def is_completed(self, url: str) -> bool:
+        """是否已成功下载过"""
+        record = await self.get_record(url)
+        return record is not None and record["status"] in DONE_STATUSES
+    
+    async def completed_urls(self, urls: List[str]) -> set:
+        """批量查询已成功下载过的URL"""
+        return {url for url in urls if await self.is_completed(url)}
+    
+    async def save_hashes(self, rows: List[tuple]):
+        """批量写入 (sha256, path) 内容哈希索引"""
+        raise NotImplementedError
+    
+    async def lookup_hash(self, sha256: str) -> Optional[str]:
+        """按内容哈希查找已保存的文件路径"""
+        raise NotImplementedError
+    
+    async def save_derivatives(self, rows: List[tuple]):
+        """批量写入 (url, name, path, width, height) 衍生图记录"""
+        raise NotImplementedError
+    
+    async def get_derivatives(self, url: str) -> List[dict]:
+        raise NotImplementedError
+
+class MySQLStateStore(StateStore):
+    """基于 aiomysql 连接池的记录存储"""
+    
+    VALIDATOR_COLUMNS = {
+        "etag": "VARCHAR(255) NULL",
+        "last_modified": "VARCHAR(64) NULL",
+        "content_length": "BIGINT NULL"
+    }
+    
+    def __init__(self, db_config: dict):
+        self.db_config = db_config
+        self.pool: Optional[aiomysql.Pool] = None
+    
+    async def open(self):
+        self.pool = await aiomysql.create_pool(**self.db_config)
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS images (
+                        url VARCHAR(768) NOT NULL PRIMARY KEY,
+                        path TEXT NOT NULL,
+                        status VARCHAR(32) NOT NULL,
+                        etag VARCHAR(255) NULL,
+                        last_modified VARCHAR(64) NULL,
+                        content_length BIGINT NULL
+                    )
+                """)
+                # 旧表补齐校验器字段
+                await cursor.execute("""
+                    SELECT COLUMN_NAME FROM information_schema.COLUMNS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'images'
+                """)
+                existing = {row[0] for row in await cursor.fetchall()}
+                for column, definition in self.VALIDATOR_COLUMNS.items():
+                    if column not in existing:
+                        await cursor.execute(f"ALTER TABLE images ADD COLUMN {column} {definition}")
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS content_hashes (
+                        sha256 CHAR(64) NOT NULL PRIMARY KEY,
+                        path TEXT NOT NULL
+                    )
+                """)
+                # url 过长无法与 name 组成主键，改用 url 的 MD5
+                await cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS derivatives (
+                        url_hash CHAR(32) NOT NULL,
+                        name VARCHAR(64) NOT NULL,
+                        url TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        width INT NOT NULL,
+                        height INT NOT NULL,
+                        PRIMARY KEY (url_hash, name)
+                    )
+                """)
+            await conn.commit()
+    
+    async def close(self):
+        self.pool.close()
+        await self.pool.wait_closed()
+    
+    async def save_records(self, rows: List[tuple]):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                try:
+                    await cursor.executemany("""
+                        INSERT INTO images (url, path, status, etag, last_modified, content_length)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                        ON DUPLICATE KEY UPDATE
+                            status = VALUES(status),
+                            path = IF(VALUES(path) = '', path, VALUES(path)),
+                            etag = COALESCE(VALUES(etag), etag),
+                            last_modified = COALESCE(VALUES(last_modified), last_modified),
+                            content_length = COALESCE(VALUES(content_length), content_length)
+                    """, rows)
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+    
+    async def delete_records(self, urls: List[str]):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany("DELETE FROM images WHERE url = %s", [(url,) for url in urls])
+            await conn.commit()
+    
+    async def get_record(self, url: str) -> Optional[dict]:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute("""
+                    SELECT url, path, status, etag, last_modified, content_length
+                    FROM images WHERE url = %s
+                """, (url,))
+                return await cursor.fetchone()
+    
+    async def completed_urls(self, urls: List[str]) -> set:
+        if not urls:
+            return set()
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(
+                    f"SELECT url FROM images WHERE url IN ({','.join(['%s'] * len(urls))}) "
+                    f"AND status IN ({','.join(['%s'] * len(DONE_STATUSES))})",
+                    (*urls, *DONE_STATUSES)
+                )
+                return {row[0] for row in await cursor.fetchall()}
+    
+    async def save_hashes(self, rows: List[tuple]):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(
+                    "INSERT IGNORE INTO content_hashes (sha256, path) VALUES (%s, %s)", rows
+                )
+            await conn.commit()
+    
+    async def save_derivatives(self, rows: List[tuple]):
+        rows = [(hashlib.md5(url.encode()).hexdigest(), name, url, path, width, height)
+                for url, name, path, width, height in rows]
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany("""
+                    INSERT INTO derivatives (url_hash, name, url, path, width, height)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        path = VALUES(path), width = VALUES(width), height = VALUES(height)
+                """, rows)
+            await conn.commit()
+    
+    async def get_derivatives(self, url: str) -> List[dict]:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(
+                    "SELECT name, path, width, height FROM derivatives WHERE url_hash = %s",
+                    (hashlib.md5(url.encode()).hexdigest(),)
+                )
+                return list(await cursor.fetchall())
+    
+    async def lookup_hash(self, sha256: str) -> Optional[str]:
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT path FROM content_hashes WHERE sha256 = %s", (sha256,))
+                row = await cursor.fetchone()
+        return row[0] if row else None
+
+class SQLiteStateStore(StateStore):
+    """基于 aiosqlite 的本地记录存储（WAL模式，无需数据库服务）"""
+    
+    VALIDATOR_COLUMNS = {
+        "etag": "TEXT",
+        "last_modified": "TEXT",
+        "content_length": "INTEGER"
+    }
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = None
+        # 各 RecordWriter 共用一个连接：写入和提交/回滚必须成对串行，
+        # 否则一个批次失败回滚时会连带丢弃另一个批次尚未提交的写入
+        self._write_lock = asyncio.Lock()
+    
+    async def open(self):
+        if aiosqlite is None:
+            raise RuntimeError("SQLite state store requires aiosqlite: pip install aiosqlite")
+        db_dir = os.path.dirname(self.path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = await aiosqlite.connect(self.path)
+        self.conn.row_factory = aiosqlite.Row
+        await self.conn.execute("PRAGMA journal_mode=WAL")
+        await self.conn.execute("PRAGMA synchronous=NORMAL")
+        # url 为主键，按URL查询直接走索引
+        await self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                url TEXT NOT NULL PRIMARY KEY,
+                path TEXT NOT NULL,
+                status TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                content_length INTEGER
+            )
+        """)
+        # 旧表补齐校验器字段
+        async with self.conn.execute("PRAGMA table_info(images)") as cursor:
+            existing = {row["name"] for row in await cursor.fetchall()}
+        for column, definition in self.VALIDATOR_COLUMNS.items():
+            if column not in existing:
+                await self.conn.execute(f"ALTER TABLE images ADD COLUMN {column} {definition}")
+        await self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS content_hashes (
+                sha256 TEXT NOT NULL PRIMARY KEY,
+                path TEXT NOT NULL
+            )
+        """)
+        await self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS derivatives (
+                url TEXT NOT NULL,
+                name TEXT NOT NULL,
+                path TEXT NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                PRIMARY KEY (url, name)
+            )
+        """)
+        await self.conn.commit()
+    
+    async def close(self):
+        await self.conn.close()
+    
+    async def _write(self, sql: str, rows: List[tuple]):
+        """在写锁内执行一批写入并提交，失败时只回滚这一批"""
+        async with self._write_lock:
+            try:
+                await self.conn.executemany(sql, rows)
+                await self.conn.commit()
+            except Exception:
+                await self.conn.rollback()
+                raise
+    
+    async def save_records(self, rows: List[tuple]):
+        await self._write("""
+            INSERT INTO images (url, path, status, etag, last_modified, content_length)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(url) DO UPDATE SET
+                status = excluded.status,
+                path = CASE WHEN excluded.path = '' THEN images.path ELSE excluded.path END,
+                etag = COALESCE(excluded.etag, images.etag),
+                last_modified = COALESCE(excluded.last_modified, images.last_modified),
+                content_length = COALESCE(excluded.content_length, images.content_length)
+        """, rows)
+    
+    async def delete_records(self, urls: List[str]):
+        await self._write("DELETE FROM images WHERE url = ?", [(url,) for url in urls])
+    
+    async def get_record(self, url: str) -> Optional[dict]:
+        async with self.conn.execute("""
+            SELECT url, path, status, etag, last_modified, content_length
+            FROM images WHERE url = ?
+        """, (url,)) as cursor:
+            row = await cursor.fetchone()
+        return dict(row) if row is not None else None
+    
+    async def is_completed(self, url: str) -> bool:
+        async with self.conn.execute(
+            f"SELECT 1 FROM images WHERE url = ? AND status IN ({','.join('?' * len(DONE_STATUSES))})",
+            (url, *DONE_STATUSES)
+        ) as cursor:
+            return await cursor.fetchone() is not None
+    
+    async def completed_urls(self, urls: List[str]) -> set:
+        if not urls:
+            return set()
+        async with self.conn.execute(
+            f"SELECT url FROM images WHERE url IN ({','.join('?' * len(urls))}) "
+            f"AND status IN ({','.join('?' * len(DONE_STATUSES))})",
+            (*urls, *DONE_STATUSES)
+        ) as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+    
+    async def save_hashes(self, rows: List[tuple]):
+        await self._write("INSERT OR IGNORE INTO content_hashes (sha256, path) VALUES (?, ?)", rows)
+    
+    async def save_derivatives(self, rows: List[tuple]):
+        await self._write("""
+            INSERT INTO derivatives (url, name, path, width, height) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(url, name) DO UPDATE SET
+                path = excluded.path, width = excluded.width, height = excluded.height
+        """, rows)
+    
+    async def get_derivatives(self, url: str) -> List[dict]:
+        async with self.conn.execute(
+            "SELECT name, path, width, height FROM derivatives WHERE url = ?", (url,)
+        ) as cursor:
+            return [dict(row) for row in await cursor.fetchall()]
+    
+    async def lookup_hash(self, sha256: str) -> Optional[str]:
+        async with self.conn.execute("SELECT path FROM content_hashes WHERE sha256 = ?", (sha256,)) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+def create_state_store(config: dict) -> StateStore:
+    """根据配置创建记录存储后端"""
+    backend = config["state_store"]["backend"]
+    if backend == "mysql":
+        return MySQLStateStore(config["db_config"])
+    if backend == "sqlite":
+        return SQLiteStateStore(config["state_store"]["sqlite_path"])
+    raise ValueError(f"Unknown state store backend: {backend}")
+
+class RecordWriter:
+    """后台批量写入图片记录：有界队列缓冲，按批量大小或时间间隔刷新
+    
+    批量写入失败时按指数退避重试，重试耗尽后逐条写入，只丢弃写不进去的记录
+    """
+    
+    _STOP = object()
+    
+    def __init__(self, flush_func, batch_size: int = 500, flush_interval: float = 1.0, max_queue: int = 10000,
+                 max_retries: int = 3, retry_delay: float = 0.5):
+        self.flush_func = flush_func
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._task: Optional[asyncio.Task] = None
+    
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+    
+    async def put(self, row: tuple):
+        """加入一条记录，队列满时等待（对下载任务形成背压）"""
+        await self.queue.put(row)
+    
+    async def close(self):
+        """刷新所有剩余记录并停止后台任务"""
+        if self._task is None:
+            return
+        await self.queue.put(self._STOP)
+        await self._task
+        self._task = None
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch: List[tuple] = []
+        deadline = 0.0
+        while True:
+            timeout = max(deadline - loop.time(), 0) if batch else None
+            try:
+                row = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                await self._flush(batch)
+                batch = []
+                continue
+            
+            if row is self._STOP:
+                await self._flush(batch)
+                return
+            if not batch:
+                deadline = loop.time() + self.flush_interval
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                await self._flush(batch)
+                batch = []
+    
+    async def _flush(self, batch: List[tuple]):
+        if not batch:
+            return
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.flush_func(batch)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.warning("Failed to save %d records, writing them one by one: %s", len(batch), e)
+                    break
+                logger.warning("Failed to save %d records, retrying in %.1fs: %s", len(batch), delay, e)
+            await asyncio.sleep(delay)
+            delay *= 2
+        
+        # 逐条写入，只丢弃本身无法写入的记录
+        for row in batch:
+            try:
+                await self.flush_func([row])
+            except Exception as e:
+                logger.error("Failed to save record %s: %s", row[0], e)
+
+class DownloadPipeline:
+    """有界流水线：按主机排队的URL → 下载任务（请求、尺寸嗅探、写盘）→ 转码队列 → 转码工作者 → RecordWriter
+    
+    待下载URL按主机放在各自的队列中，只有 HostScheduler 分给该主机槽位时才启动下载，
+    慢主机不会占满全部并发，其他主机仍按轮询得到槽位。
+    排队URL总数超过 queue_size 时上游在 put 处等待，内存占用与发现的URL总数无关；任一任务异常时取消整条流水线。
+    每个URL在最后一个阶段处理完后回调 on_done。
+    """
+    
+    _STOP = object()
+    
+    def __init__(self, downloader: "ImageDownloader", folder: str,
+                 on_done: Optional[Callable[[str], Any]] = None):
+        settings = downloader.config["pipeline"]
+        self.downloader = downloader
+        self.folder = folder
+        self.on_done = on_done
+        self.transcode_workers = settings["transcode_workers"] or downloader.config["transcode"]["workers"] or os.cpu_count()
+        # 排队中（尚未开始下载）的URL名额
+        self._queue_slots = asyncio.Semaphore(settings["queue_size"])
+        # 主机 -> 待下载URL；每个有排队URL的主机有一个分发任务
+        self._hosts: Dict[str, deque] = {}
+        self.transcodes: asyncio.Queue = asyncio.Queue(maxsize=settings["transcode_queue_size"])
+        # URL -> 尚未处理完的阶段数，归零时回调 on_done
+        self._pending: Dict[str, int] = defaultdict(int)
+        # 排队或下载中的URL数，归零时 _idle 置位
+        self._unfinished = 0
+        self._idle: Optional[asyncio.Event] = None
+        # 各主机的分发任务和进行中的下载任务
+        self._downloaders: set = set()
+        self._transcoders: List[asyncio.Task] = []
+        self._failed: Optional[asyncio.Future] = None
+    
+    async def __aenter__(self):
+        self.start()
+        return self
+    
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            await self.close()
+        else:
+            await self.abort()
+    
+    def start(self):
+        self._failed = asyncio.get_running_loop().create_future()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.downloader.pipeline = self
+        self._transcoders = [asyncio.create_task(self._guard(self._transcode_worker())) for _ in range(self.transcode_workers)]
+    
+    async def put(self, url: str):
+        """加入一个待下载URL，排队已满时等待；流水线已失败时抛出异常"""
+        if self._failed.done():
+            self._failed.result()
+        acquire = asyncio.ensure_future(self._queue_slots.acquire())
+        await asyncio.wait([acquire, self._failed], return_when=asyncio.FIRST_COMPLETED)
+        if not acquire.done():
+            acquire.cancel()
+            self._failed.result()
+        self._pending[url] += 1
+        self.downloader.progress.add()
+        self._unfinished += 1
+        self._idle.clear()
+        host = urlparse(url).netloc
+        queue = self._hosts.get(host)
+        if queue is None:
+            queue = self._hosts[host] = deque()
+            self._spawn(self._dispatch_host(host, queue))
+        queue.append(url)
+    
+    async def transcode(self, url: str, source, filepath: str, validators: tuple, sha256: str, reserved: int = 0):
+        """下载阶段把图片交给转码阶段；reserved 为随任务转交的内存预算"""
+        self._pending[url] += 1
+        await self.transcodes.put((url, source, filepath, validators, sha256, reserved))
+    
+    async def close(self):
+        """处理完所有已加入的URL后停止各阶段"""
+        try:
+            idle = asyncio.ensure_future(self._idle.wait())
+            await asyncio.wait([idle, self._failed], return_when=asyncio.FIRST_COMPLETED)
+            idle.cancel()
+            if not self._failed.done():
+                for _ in self._transcoders:
+                    await self._put_stop(self.transcodes)
+            # 失败时其余任务已被取消，收集结果后抛出真正的异常而不是 CancelledError
+            await asyncio.gather(*self._downloaders, *self._transcoders, return_exceptions=True)
+        finally:
+            self.downloader.pipeline = None
+        if self._failed.done():
+            self._failed.result()
+    
+    async def abort(self):
+        tasks = list(self._downloaders) + self._transcoders
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.downloader.pipeline = None
+    
+    async def _put_stop(self, queue: asyncio.Queue):
+        put = asyncio.ensure_future(queue.put(self._STOP))
+        await asyncio.wait([put, self._failed], return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+    
+    def _spawn(self, coro: Awaitable):
+        task = asyncio.create_task(self._guard(coro))
+        self._downloaders.add(task)
+        task.add_done_callback(self._downloaders.discard)
+    
+    async def _guard(self, worker: Awaitable):
+        try:
+            await worker
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Pipeline worker failed: %s", e)
+            if not self._failed.done():
+                self._failed.set_exception(e)
+            for task in list(self._downloaders) + self._transcoders:
+                if task is not asyncio.current_task():
+                    task.cancel()
+    
+    def _finish(self, url: str):
+        self._pending[url] -= 1
+        if self._pending[url] <= 0:
+            del self._pending[url]
+            if self.on_done is not None:
+                self.on_done(url)
+    
+    async def _dispatch_host(self, host: str, queue: deque):
+        """每获得一个该主机的槽位就启动一个下载；等待槽位时不占用其他主机的并发"""
+        scheduler = self.downloader.scheduler
+        while queue:
+            await scheduler.acquire(host)
+            # 只有本任务从 queue 取出URL，acquire 返回后 queue 仍非空
+            url = queue.popleft()
+            self._queue_slots.release()
+            self._spawn(self._download(url, host))
+        del self._hosts[host]
+    
+    async def _download(self, url: str, host: str):
+        try:
+            await self.downloader.fetch_image(url, self.folder)
+        finally:
+            self.downloader.scheduler.release(host)
+        # 被取消或异常退出的URL不算完成，断点恢复时会重新下载
+        self._finish(url)
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._idle.set()
+    
+    async def _transcode_worker(self):
+        while True:
+            job = await self.transcodes.get()
+            if job is self._STOP:
+                return
+            url, source, filepath, validators, sha256, reserved = job
+            try:
+                await self.downloader.complete_image(url, source, filepath, validators, sha256)
+            finally:
+                if reserved:
+                    await self.downloader.transcode_budget.release(reserved)
+            self._finish(url)
+
+# 按扩展名判断 <a href> 链接是否直接指向图片
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".avif", ".tif", ".tiff")
+
+# 懒加载图片常用的属性
+LAZY_ATTRIBUTES = ("data-src", "data-original", "data-lazy-src", "data-lazy", "data-url", "data-bg", "data-background")
+LAZY_SRCSET_ATTRIBUTES = ("srcset", "data-srcset", "data-lazy-srcset")
+CSS_URL_RE = re.compile(r"""url\(\s*['"]?([^'")]+?)['"]?\s*\)""")
+
+def pick_srcset(srcset: str) -> Optional[str]:
+    """从 srcset 中选出分辨率最大的候选（按 w 或 x 描述符）"""
+    best, best_score = None, -1.0
+    for candidate in srcset.split(","):
+        parts = candidate.strip().split()
+        if not parts or parts[0].startswith("data:"):
+            continue
+        score = 1.0
+        if len(parts) > 1:
+            descriptor = parts[-1].lower()
+            try:
+                if descriptor.endswith("w"):
+                    score = float(descriptor[:-1])
+                elif descriptor.endswith("x"):
+                    score = float(descriptor[:-1])
+            except ValueError:
+                pass
+        if score >= best_score:
+            best, best_score = parts[0], score
+    return best
+
+def _collect_urls(elements, style_blocks, base_url: str) -> Tuple[List[str], List[str]]:
+    """从 (标签名, 属性) 序列中收集图片地址和页面链接"""
+    images, links = [], []
+    for tag, attrs in elements:
+        if tag in ("img", "source"):
+            srcset = next((attrs[a] for a in LAZY_SRCSET_ATTRIBUTES if attrs.get(a)), None)
+            src = pick_srcset(srcset) if srcset else None
+            if not src:
+                src = next(
+                    (attrs[a] for a in LAZY_ATTRIBUTES + ("src",)
+                     if attrs.get(a) and not attrs[a].startswith("data:")),
+                    None
+                )
+            if src:
+                images.append(src)
+        else:
+            for attr in LAZY_ATTRIBUTES:
+                if attrs.get(attr):
+                    images.append(attrs[attr])
+            if tag == "a" and attrs.get("href"):
+                links.append(attrs["href"])
+        style = attrs.get("style")
+        if style and "url(" in style:
+            images.extend(CSS_URL_RE.findall(style))
+    for block in style_blocks:
+        if block and "url(" in block:
+            images.extend(CSS_URL_RE.findall(block))
+    
+    images = [urljoin(base_url, u.strip()) for u in images if not u.strip().startswith("data:")]
+    links = [urljoin(base_url, u.strip()) for u in links]
+    return images, links
+
+def extract_page_urls(html: str, base_url: str, parser: str = "lxml") -> Tuple[List[str], List[str]]:
+    """解析HTML，返回 (图片URL列表, 链接URL列表)；在工作线程/进程中执行"""
+    if parser == "lxml" and lxml is not None:
+        try:
+            doc = lxml.html.fromstring(html)
+        except (ParserError, ValueError):
+            # 带编码声明的 XHTML（str 不能带 <?xml encoding?>）或空文档，交给 BeautifulSoup 解析
+            doc = None
+        if doc is not None:
+            lazy = " or ".join(f"@{a}" for a in LAZY_ATTRIBUTES)
+            elements = (
+                (el.tag, el.attrib)
+                for el in doc.xpath(f"//img | //source | //a[@href] | //*[@style] | //*[{lazy}]")
+            )
+            return _collect_urls(elements, doc.xpath("//style/text()"), base_url)
+    
+    soup = BeautifulSoup(html, "html.parser")
+    elements = ((tag.name, tag.attrs) for tag in soup.find_all(True))
+    return _collect_urls(elements, (tag.string for tag in soup.find_all("style")), base_url)
+
+class BloomFilter:
+    """定长位数组布隆过滤器，内存占用与URL数量无关"""
+    
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+    
+    def _positions(self, item: str):
+        # 双重哈希：h1 + i*h2 生成 k 个位置
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+    
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+    
+    def add(self, item: str) -> bool:
+        """加入元素，返回是否为新元素"""
+        added = False
+        for pos in self._positions(item):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                self.bits[pos >> 3] |= mask
+                added = True
+        return added
+    
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(self.bits)
+    
+    def load(self, path: str):
+        with open(path, "rb") as f:
+            bits = f.read()
+        if len(bits) != len(self.bits):
+            raise ValueError("Bloom filter size does not match configuration")
+        self.bits = bytearray(bits)
+
+class CrawlFrontier:
+    """抓取边界：按深度优先级的页面队列 + 图片队列，布隆过滤器去重，可持久化"""
+    
+    def __init__(self, start_url: str, config: dict):
+        self.start_url = start_url
+        self.max_depth = config["max_depth"]
+        self.max_pages = config["max_pages"]
+        self.same_domain = config["same_domain"]
+        self.allow_domains = [d.lower() for d in config["allow_domains"]]
+        self.state_file = config["frontier_file"]
+        self.start_host = urlparse(start_url).netloc.lower()
+        self.seen = BloomFilter(config["bloom_capacity"], config["bloom_error_rate"])
+        self.pages: List[Tuple[int, int, str]] = []
+        self.images: deque = deque()
+        self.in_flight: set = set()
+        self.pages_crawled = 0
+        self._seq = 0
+    
+    @staticmethod
+    def normalize(url: str) -> str:
+        """去掉片段，协议和主机转为小写；查询参数保留（分页、签名URL依赖它）"""
+        parsed = urlparse(url)
+        # 用户信息区分大小写，只转换主机部分
+        userinfo, at, host = parsed.netloc.rpartition("@")
+        netloc = userinfo + at + host.lower()
+        return urlunparse(parsed._replace(scheme=parsed.scheme.lower(), netloc=netloc, fragment=""))
+    
+    def in_scope(self, url: str) -> bool:
+        """页面是否在抓取范围内（同域名或允许列表）"""
+        host = urlparse(url).netloc.lower()
+        if self.allow_domains:
+            return any(host == d or host.endswith("." + d) for d in self.allow_domains)
+        return not self.same_domain or host == self.start_host
+    
+    def add_page(self, url: str, depth: int):
+        url = self.normalize(url)
+        if depth <= self.max_depth and self.in_scope(url) and self.seen.add("page:" + url):
+            heapq.heappush(self.pages, (depth, self._seq, url))
+            self._seq += 1
+    
+    def add_image(self, url: str):
+        url = self.normalize(url)
+        if self.seen.add("image:" + url):
+            self.images.append(url)
+    
+    def next_page(self) -> Optional[Tuple[int, str]]:
+        """按深度取出下一个待抓取页面（BFS）"""
+        if not self.pages or self.pages_crawled >= self.max_pages:
+            return None
+        depth, _, url = heapq.heappop(self.pages)
+        self.pages_crawled += 1
+        return depth, url
+    
+    def take_images(self) -> List[str]:
+        urls = list(self.images)
+        self.images.clear()
+        self.in_flight.update(urls)
+        return urls
+    
+    def images_done(self, urls: List[str]):
+        self.in_flight.difference_update(urls)
+    
+    def save(self):
+        """保存边界状态（未下载完的图片也一并保存，恢复后重新入队）"""
+        if self.state_file:
+            self.write_snapshot(self.snapshot())
+    
+    async def checkpoint(self):
+        """定期保存：在事件循环上复制状态，写文件（含整个布隆过滤器）交给线程池"""
+        if self.state_file:
+            await asyncio.get_running_loop().run_in_executor(None, self.write_snapshot, self.snapshot())
+    
+    def snapshot(self) -> Tuple[dict, bytes]:
+        """复制当前状态，之后抓取继续修改边界也不影响正在写入的快照"""
+        state = {
+            "start_url": self.start_url,
+            "pages": list(self.pages),
+            "images": list(self.in_flight) + list(self.images),
+            "pages_crawled": self.pages_crawled,
+            "seq": self._seq
+        }
+        return state, bytes(self.seen.bits)
+    
+    def write_snapshot(self, snapshot: Tuple[dict, bytes]):
+        state, bits = snapshot
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        with open(self.state_file + ".bloom.tmp", "wb") as f:
+            f.write(bits)
+        with open(self.state_file + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.state_file + ".bloom.tmp", self.state_file + ".bloom")
+        os.replace(self.state_file + ".tmp", self.state_file)
+    
+    def load(self) -> bool:
+        """恢复同一起始URL的未完成抓取，返回是否成功恢复"""
+        if not self.state_file or not os.path.exists(self.state_file):
+            return False
+        try:
+            with open(self.state_file, "r") as f:
+                state = json.load(f)
+            if state["start_url"] != self.start_url:
+                return False
+            self.seen.load(self.state_file + ".bloom")
+        except (OSError, ValueError, KeyError) as e:
+            console.print(f"[yellow]Frontier state ignored: {str(e)}[/yellow]")
+            return False
+        self.pages = [tuple(item) for item in state["pages"]]
+        heapq.heapify(self.pages)
+        self.images = deque(state["images"])
+        self.pages_crawled = state["pages_crawled"]
+        self._seq = state["seq"]
+        return True
+    
+    def clear(self):
+        """抓取正常结束后删除状态文件"""
+        if not self.state_file:
+            return
+        for path in (self.state_file, self.state_file + ".bloom"):
+            if os.path.exists(path):
+                os.remove(path)
+
+class UrlListReader:
+    """流式读取URL列表（txt/csv/jsonl，"-" 表示标准输入），记录每行的字节偏移以便断点续读
+    
+    csv 按列名（首行为表头时）或列序号取URL；jsonl 取每行对象的 url 字段。
+    """
+    
+    FORMATS = ("txt", "csv", "jsonl")
+    
+    def __init__(self, path: str, fmt: str = "auto", column: str = "url"):
+        self.path = path
+        self.fmt = self.detect_format(path) if fmt == "auto" else fmt
+        self.column = column
+        self.offset = 0
+        self._file = None
+        self._column_index: Optional[int] = None
+    
+    @classmethod
+    def detect_format(cls, path: str) -> str:
+        ext = os.path.splitext(path)[1].lower().lstrip(".")
+        if ext in ("json", "ndjson"):
+            return "jsonl"
+        return ext if ext in cls.FORMATS else "txt"
+    
+    @property
+    def seekable(self) -> bool:
+        return self.path != "-"
+    
+    def open(self, offset: int = 0):
+        self._file = sys.stdin.buffer if self.path == "-" else open(self.path, "rb")
+        if self.fmt == "csv":
+            self._read_header()
+        if offset > self.offset and self.seekable:
+            self._file.seek(offset)
+            self.offset = offset
+    
+    def close(self):
+        if self._file is not None and self._file is not sys.stdin.buffer:
+            self._file.close()
+        self._file = None
+    
+    def _read_header(self):
+        """列名为数字时直接作为列序号；否则首行必须是包含该列名的表头"""
+        if self.column.isdigit():
+            self._column_index = int(self.column)
+            return
+        line = self._file.readline()
+        self.offset += len(line)
+        header = next(csv.reader([line.decode("utf-8-sig")]), [])
+        if self.column not in header:
+            raise ValueError(f"CSV column not found: {self.column}")
+        self._column_index = header.index(self.column)
+    
+    def parse(self, line: str) -> Optional[str]:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            return None
+        if self.fmt == "jsonl":
+            value = json.loads(line)
+            if isinstance(value, dict) and value.get("accepted") is False:
+                # discover 生成的清单中已被过滤掉的行
+                return None
+            url = value.get("url") if isinstance(value, dict) else value
+        elif self.fmt == "csv":
+            row = next(csv.reader([line]), [])
+            url = row[self._column_index] if len(row) > self._column_index else None
+        else:
+            url = line
+        return url.strip() if isinstance(url, str) else None
+    
+    def read_batch(self, size: int) -> List[Tuple[int, Optional[str]]]:
+        """读取最多 size 行，返回 (行起始偏移, URL) 列表；无法解析的行 URL 为 None"""
+        batch = []
+        while len(batch) < size:
+            line = self._file.readline()
+            if not line:
+                break
+            start = self.offset
+            self.offset += len(line)
+            try:
+                batch.append((start, self.parse(line.decode("utf-8", errors="replace"))))
+            except (ValueError, AttributeError):
+                batch.append((start, None))
+        return batch
+
+class OffsetWatermark:
+    """在途行偏移的低水位：低于水位的行都已处理完，可作为续读位置"""
+    
+    def __init__(self):
+        self._heap: List[int] = []
+        self._finished: set = set()
+    
+    def start(self, offset: int):
+        heapq.heappush(self._heap, offset)
+    
+    def finish(self, offset: int):
+        self._finished.add(offset)
+        while self._heap and self._heap[0] in self._finished:
+            self._finished.remove(heapq.heappop(self._heap))
+    
+    def value(self, read_offset: int) -> int:
+        return self._heap[0] if self._heap else read_offset
+
+class ProxyStats:
+    """单个代理的延迟与成功率统计"""
+    
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.success = 0
+        self.failure = 0
+        self.consecutive_failures = 0
+    
+    @property
+    def score(self) -> float:
+        # 平滑成功率 / 延迟：又快又稳的代理权重更高
+        success_rate = (self.success + 1) / (self.success + self.failure + 2)
+        return success_rate / max(self.latency, 0.05)
+
+class ProxyManager:
+    """代理池管理：后台刷新与并发健康检查，按得分加权选择，坏代理隔离后定期复测"""
+    
+    def __init__(self, config: dict):
+        self.source = config["proxy_pool"]
+        self.country = config["proxy_country"]
+        self.settings = config["proxy_manager"]
+        self.auth: Optional[aiohttp.BasicAuth] = None
+        if config["proxy_auth"]:
+            user, _, password = config["proxy_auth"].partition(":")
+            self.auth = aiohttp.BasicAuth(user, password)
+        self.active: Dict[str, ProxyStats] = {}
+        # 被隔离的代理 -> 下次复测时间
+        self.quarantine: Dict[str, float] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.transport: Optional[Transport] = None
+        self._task: Optional[asyncio.Task] = None
+        # 可用代理达到 min_ready 或首次检查结束时置位
+        self._ready: Optional[asyncio.Event] = None
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.source or self.settings["proxies"])
+    
+    async def start(self):
+        """启动后台刷新任务，等到足够多的代理通过检查或超时后返回，首次检查在后台继续"""
+        if not self.enabled:
+            return
+        self.session = aiohttp.ClientSession()
+        self._ready = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self._ready.wait(), self.settings["startup_timeout"])
+        except asyncio.TimeoutError:
+            logger.warning("Proxy check still running, starting with %d proxies", len(self.active))
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.session is not None:
+            await self.session.close()
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        await self.refresh()
+        self._ready.set()
+        last_refresh = loop.time()
+        while True:
+            await asyncio.sleep(self.settings["retest_interval"])
+            now = loop.time()
+            due = [proxy for proxy, retest_at in self.quarantine.items() if retest_at <= now]
+            if due:
+                await self.check_all(due)
+            if now - last_refresh >= self.settings["refresh_interval"]:
+                await self.refresh()
+                last_refresh = loop.time()
+    
+    async def load_pool(self) -> List[str]:
+        """从代理源和静态列表加载代理地址"""
+        proxies = list(self.settings["proxies"])
+        if self.source:
+            url = self.source
+            if self.country and "country=" not in url:
+                url += f"&country={self.country}"
+            try:
+                async with self.session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    if response.status == 200:
+                        proxies.extend((await response.text()).splitlines())
+            except Exception as e:
+                logger.error("Proxy pool loading failed: %s", e)
+        
+        normalized = []
+        for proxy in proxies:
+            proxy = proxy.strip()
+            if proxy:
+                normalized.append(proxy if "://" in proxy else f"http://{proxy}")
+        return normalized
+    
+    async def refresh(self):
+        """重新加载代理源，并发检查新出现的代理"""
+        new = [p for p in await self.load_pool() if p not in self.active and p not in self.quarantine]
+        await self.check_all(new)
+    
+    async def check_all(self, proxies: List[str]):
+        sem = asyncio.Semaphore(self.settings["check_concurrency"])
+        
+        async def check(proxy: str):
+            async with sem:
+                await self.check(proxy)
+        
+        await asyncio.gather(*(check(proxy) for proxy in proxies))
+    
+    async def check(self, proxy: str) -> bool:
+        """通过代理访问检查地址，成功则加入可用池，失败则隔离"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            async with self.session.get(
+                self.settings["check_url"],
+                proxy=proxy,
+                proxy_auth=self.auth,
+                timeout=aiohttp.ClientTimeout(total=self.settings["check_timeout"])
+            ) as response:
+                ok = response.status == 200
+        except Exception:
+            ok = False
+        
+        if ok:
+            self.quarantine.pop(proxy, None)
+            stats = self.active.setdefault(proxy, ProxyStats(loop.time() - started))
+            stats.consecutive_failures = 0
+            if self._ready is not None and len(self.active) >= self.settings["min_ready"]:
+                self._ready.set()
+        else:
+            self.active.pop(proxy, None)
+            self.quarantine[proxy] = loop.time() + self.settings["retest_interval"]
+        return ok
+    
+    def pick(self) -> Optional[str]:
+        """按得分加权随机选择代理，不做额外探测"""
+        if not self.active:
+            return None
+        proxies = list(self.active)
+        return random.choices(proxies, weights=[self.active[p].score for p in proxies])[0]
+    
+    def report(self, proxy: Optional[str], ok: bool, latency: Optional[float] = None):
+        """记录一次真实请求的结果，连续失败过多时隔离代理"""
+        stats = self.active.get(proxy) if proxy else None
+        if stats is None:
+            return
+        if ok:
+            stats.success += 1
+            stats.consecutive_failures = 0
+            if latency is not None:
+                alpha = self.settings["latency_alpha"]
+                stats.latency = alpha * latency + (1 - alpha) * stats.latency
+        else:
+            stats.failure += 1
+            stats.consecutive_failures += 1
+            if stats.consecutive_failures >= self.settings["max_failures"]:
+                del self.active[proxy]
+                self.quarantine[proxy] = asyncio.get_running_loop().time() + self.settings["retest_interval"]
+
+class JobQueue:
+    """分布式任务队列接口：按URL哈希分片，取出的任务在可见性超时内未确认会重新入队"""
+    
+    def __init__(self, shards: int, visibility_timeout: int):
+        self.shards = shards
+        self.visibility_timeout = visibility_timeout
+    
+    def shard_of(self, url: str) -> int:
+        return int.from_bytes(hashlib.md5(url.encode()).digest()[:4], "big") % self.shards
+    
+    async def put(self, urls: List[str]):
+        raise NotImplementedError
+    
+    async def get(self, shards: List[int]) -> Optional[str]:
+        """从指定分片中取出一个任务（返回任务句柄，无任务时返回 None）"""
+        raise NotImplementedError
+    
+    async def ack(self, job: str):
+        raise NotImplementedError
+    
+    async def requeue_expired(self) -> int:
+        """把超时未确认的任务放回原分片，返回数量"""
+        raise NotImplementedError
+    
+    async def mark_finished(self):
+        """协调者结束URL发现"""
+        raise NotImplementedError
+    
+    async def is_drained(self) -> bool:
+        """发现已结束且所有任务都已确认"""
+        raise NotImplementedError
+    
+    async def reset(self, keep_jobs: bool = False):
+        """协调者启动时清除上一轮的结束标记；keep_jobs 为 False 时同时丢弃上一轮遗留的任务"""
+        raise NotImplementedError
+    
+    async def close(self):
+        pass
+    
+    @staticmethod
+    def url_of(job: str) -> str:
+        # 任务句柄格式：<分片>|<URL>
+        return job.split("|", 1)[1]
+
+class MemoryJobQueue(JobQueue):
+    """进程内任务队列，语义与 Redis 队列一致，用于单机和测试"""
+    
+    def __init__(self, shards: int, visibility_timeout: int):
+        super().__init__(shards, visibility_timeout)
+        self.queues = [deque() for _ in range(shards)]
+        self.inflight: Dict[str, float] = {}
+        self.finished = False
+    
+    async def put(self, urls: List[str]):
+        for url in urls:
+            self.queues[self.shard_of(url)].appendleft(url)
+    
+    async def get(self, shards: List[int]) -> Optional[str]:
+        for shard in shards:
+            if self.queues[shard]:
+                job = f"{shard}|{self.queues[shard].pop()}"
+                self.inflight[job] = time.time() + self.visibility_timeout
+                return job
+        return None
+    
+    async def ack(self, job: str):
+        self.inflight.pop(job, None)
+    
+    async def requeue_expired(self) -> int:
+        now = time.time()
+        expired = [job for job, deadline in self.inflight.items() if deadline <= now]
+        for job in expired:
+            del self.inflight[job]
+            shard, url = job.split("|", 1)
+            self.queues[int(shard)].append(url)
+        return len(expired)
+    
+    async def mark_finished(self):
+        self.finished = True
+    
+    async def is_drained(self) -> bool:
+        return self.finished and not self.inflight and not any(self.queues)
+    
+    async def reset(self, keep_jobs: bool = False):
+        self.finished = False
+        if not keep_jobs:
+            for queue in self.queues:
+                queue.clear()
+            self.inflight.clear()
+
+class RedisJobQueue(JobQueue):
+    """基于 Redis 的共享任务队列：每个分片一个 list，进行中的任务放在按截止时间排序的 zset"""
+    
+    # 原子地取出任务并登记到进行中集合
+    POP_SCRIPT = """
+    local url = redis.call('RPOP', KEYS[1])
+    if url then
+        redis.call('ZADD', KEYS[2], ARGV[1], ARGV[2] .. '|' .. url)
+    end
+    return url
+    """
+    # 原子地把超时任务放回原分片
+    REQUEUE_SCRIPT = """
+    local jobs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+    for _, job in ipairs(jobs) do
+        local sep = string.find(job, '|', 1, true)
+        redis.call('ZREM', KEYS[1], job)
+        redis.call('RPUSH', ARGV[2] .. string.sub(job, 1, sep - 1), string.sub(job, sep + 1))
+    end
+    return #jobs
+    """
+    
+    def __init__(self, redis_url: str, name: str, shards: int, visibility_timeout: int):
+        super().__init__(shards, visibility_timeout)
+        if aioredis is None:
+            raise RuntimeError("Redis job queue requires redis: pip install redis")
+        self.redis = aioredis.from_url(redis_url, decode_responses=True)
+        self.prefix = f"{name}:shard:"
+        self.inflight_key = f"{name}:inflight"
+        self.finished_key = f"{name}:finished"
+        self._pop = self.redis.register_script(self.POP_SCRIPT)
+        self._requeue = self.redis.register_script(self.REQUEUE_SCRIPT)
+    
+    async def put(self, urls: List[str]):
+        pipe = self.redis.pipeline(transaction=False)
+        for url in urls:
+            pipe.lpush(f"{self.prefix}{self.shard_of(url)}", url)
+        await pipe.execute()
+    
+    async def get(self, shards: List[int]) -> Optional[str]:
+        deadline = time.time() + self.visibility_timeout
+        for shard in shards:
+            url = await self._pop(keys=[f"{self.prefix}{shard}", self.inflight_key], args=[deadline, shard])
+            if url is not None:
+                return f"{shard}|{url}"
+        return None
+    
+    async def ack(self, job: str):
+        await self.redis.zrem(self.inflight_key, job)
+    
+    async def requeue_expired(self) -> int:
+        return await self._requeue(keys=[self.inflight_key], args=[time.time(), self.prefix])
+    
+    async def mark_finished(self):
+        await self.redis.set(self.finished_key, 1)
+    
+    async def is_drained(self) -> bool:
+        if not await self.redis.exists(self.finished_key):
+            return False
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zcard(self.inflight_key)
+        for shard in range(self.shards):
+            pipe.llen(f"{self.prefix}{shard}")
+        return not any(await pipe.execute())
+    
+    async def reset(self, keep_jobs: bool = False):
+        keys = [self.finished_key]
+        if not keep_jobs:
+            # 按前缀扫描，分片数改小后多出来的旧分片也一并清除
+            keys.append(self.inflight_key)
+            keys.extend([key async for key in self.redis.scan_iter(match=f"{self.prefix}*")])
+        await self.redis.delete(*keys)
+    
+    async def close(self):
+        # redis-py 5 起 close() 更名为 aclose()
+        close = getattr(self.redis, "aclose", None) or self.redis.close
+        await close()
+
+def create_job_queue(config: dict, shared: bool = False) -> JobQueue:
+    """根据配置创建分布式任务队列；shared 表示队列要在多个进程间共享（coordinator/worker 命令）"""
+    dist = config["distributed"]
+    if shared and dist["backend"] == "memory":
+        # 各进程各有一份内存队列，工作者永远等不到协调者的任务和结束标记
+        raise ValueError("distributed.backend 'memory' cannot be shared between processes, use 'redis' "
+                         "for coordinator/worker")
+    if dist["backend"] == "redis":
+        return RedisJobQueue(dist["redis_url"], dist["queue_name"], dist["shards"], dist["visibility_timeout"])
+    if dist["backend"] == "memory":
+        return MemoryJobQueue(dist["shards"], dist["visibility_timeout"])
+    raise ValueError(f"Unknown job queue backend: {dist['backend']}")
+
+class Histogram:
+    """固定分桶的延迟直方图（秒），observe 只做一次二分查找"""
+    
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    
+    __slots__ = ("counts", "total", "count")
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+    
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+    
+    def merge(self, other: "Histogram"):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.total += other.total
+        self.count += other.count
+    
+    def quantile(self, q: float) -> float:
+        """按分桶上界估算分位数"""
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else float("inf")
+        return 0.0
+
+class Metrics:
+    """按阶段/主机统计延迟直方图和计数器，支持 Prometheus 文本格式和运行结束汇总"""
+    
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+        self.counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = defaultdict(float)
+        self._runner: Optional[web.AppRunner] = None
+    
+    def observe(self, stage: str, host: str, seconds: float):
+        if not self.enabled:
+            return
+        key = (stage, host)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram()
+        hist.observe(seconds)
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        if self.enabled:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+    
+    @contextmanager
+    def timer(self, stage: str, host: str = ""):
+        """统计代码块耗时（包括其中的 await）"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, host, time.perf_counter() - started)
+    
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """aiohttp 请求追踪：DNS、建连、首字节时间"""
+        trace = aiohttp.TraceConfig()
+        
+        async def on_request_start(session, ctx, params):
+            # 与 urlparse(url).netloc 保持一致，便于和下载阶段的统计对齐
+            url = params.url
+            ctx.host = url.host if url.is_default_port() else f"{url.host}:{url.port}"
+            ctx.started = time.perf_counter()
+        
+        async def on_dns_start(session, ctx, params):
+            ctx.dns_started = time.perf_counter()
+        
+        async def on_dns_end(session, ctx, params):
+            self.observe("dns", params.host, time.perf_counter() - ctx.dns_started)
+        
+        async def on_connection_start(session, ctx, params):
+            ctx.connect_started = time.perf_counter()
+        
+        async def on_connection_end(session, ctx, params):
+            self.observe("connect", ctx.host, time.perf_counter() - ctx.connect_started)
+        
+        async def on_connection_reused(session, ctx, params):
+            self.inc("connections_reused_total", host=ctx.host)
+        
+        async def on_request_end(session, ctx, params):
+            # 收到响应头时触发，即首字节时间
+            self.observe("ttfb", ctx.host, time.perf_counter() - ctx.started)
+            self.inc("http_responses_total", host=ctx.host, status=str(params.response.status))
+        
+        async def on_request_exception(session, ctx, params):
+            self.inc("http_errors_total", host=ctx.host, error=type(params.exception).__name__)
+        
+        trace.on_request_start.append(on_request_start)
+        trace.on_dns_resolvehost_start.append(on_dns_start)
+        trace.on_dns_resolvehost_end.append(on_dns_end)
+        trace.on_connection_create_start.append(on_connection_start)
+        trace.on_connection_create_end.append(on_connection_end)
+        trace.on_connection_reuseconn.append(on_connection_reused)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        return trace
+    
+    @staticmethod
+    def _labels(labels: Dict[str, str]) -> str:
+        def escape(value) -> str:
+            return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+    
+    def render_prometheus(self) -> str:
+        """输出 Prometheus 文本格式"""
+        lines = ["# TYPE imgdl_stage_seconds histogram"]
+        for (stage, host), hist in sorted(self.histograms.items()):
+            cumulative = 0
+            for i, bound in enumerate(Histogram.BUCKETS + (float("inf"),)):
+                cumulative += hist.counts[i]
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = self._labels({"stage": stage, "host": host, "le": le})
+                lines.append(f"imgdl_stage_seconds_bucket{labels} {cumulative}")
+            labels = self._labels({"stage": stage, "host": host})
+            lines.append(f"imgdl_stage_seconds_sum{labels} {hist.total}")
+            lines.append(f"imgdl_stage_seconds_count{labels} {hist.count}")
+        names = sorted({name for name, _ in self.counters})
+        for name in names:
+            lines.append(f"# TYPE imgdl_{name} counter")
+            for (counter, labels), value in sorted(self.counters.items()):
+                if counter == name:
+                    lines.append(f"imgdl_{name}{self._labels(dict(labels))} {value:g}")
+        return "\n".join(lines) + "\n"
+    
+    async def start_server(self, port: int):
+        """启动 /metrics HTTP 端点"""
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=self.render_prometheus(), content_type="text/plain")
+        
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "0.0.0.0", port).start()
+        console.print(f"[cyan]Metrics endpoint: http://0.0.0.0:{port}/metrics[/cyan]")
+    
+    async def stop_server(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+    
+    def summary_table(self) -> Table:
+        """运行结束时的各阶段耗时汇总（跨主机合并）"""
+        stages: Dict[str, Histogram] = {}
+        for (stage, _), hist in self.histograms.items():
+            stages.setdefault(stage, Histogram()).merge(hist)
+        table = Table(title="Stage timings")
+        for column in ("stage", "count", "total s", "mean ms", "p50 ≤ ms", "p95 ≤ ms", "p99 ≤ ms"):
+            table.add_column(column, justify="left" if column == "stage" else "right")
+        for stage, hist in sorted(stages.items()):
+            table.add_row(
+                stage,
+                str(hist.count),
+                f"{hist.total:.2f}",
+                f"{hist.total / hist.count * 1000:.1f}",
+                *(f"{hist.quantile(q) * 1000:g}" for q in (0.5, 0.95, 0.99))
+            )
+        return table
+
+class ProgressReporter:
+    """汇总进度显示：下载路径上只累加计数，由定时任务按 interval 刷新 rich Progress，不逐张输出"""
+    
+    def __init__(self, enabled: bool, interval: float):
+        self.enabled = enabled
+        self.interval = interval
+        self.total = 0
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.bytes = 0
+        self.retries = 0
+        self.progress: Optional[Progress] = None
+        self._progress_task = None
+        self._task: Optional[asyncio.Task] = None
+        self._started = 0.0
+    
+    def start(self):
+        if not self.enabled:
+            return
+        self._started = time.monotonic()
+        # 不使用 rich 的自动刷新线程，由事件循环上的定时任务统一刷新
+        self.progress = Progress(
+            TextColumn("[bold]{task.description}"),
+            BarColumn(),
+            MofNCompleteColumn(),
+            TimeRemainingColumn(),
+            TextColumn("{task.fields[detail]}"),
+            console=console,
+            auto_refresh=False
+        )
+        self._progress_task = self.progress.add_task("Images", total=None, detail="")
+        self.progress.start()
+        self._task = asyncio.create_task(self._run())
+    
+    def add(self, count: int = 1):
+        """登记加入队列的图片数（进度条总数）"""
+        self.total += count
+    
+    def count(self, status: str):
+        self.counts[status] += 1
+    
+    def add_bytes(self, size: int):
+        self.bytes += size
+    
+    def retry(self):
+        self.retries += 1
+    
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.progress is not None:
+            # 结束时显示整个运行期间的平均速率
+            self.refresh(self.bytes / max(time.monotonic() - self._started, 1e-6))
+            self.progress.stop()
+            self.progress = None
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_time, last_bytes = loop.time(), self.bytes
+        while True:
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            self.refresh((self.bytes - last_bytes) / (now - last_time))
+            last_time, last_bytes = now, self.bytes
+    
+    def refresh(self, rate: float):
+        done = sum(self.counts.values())
+        detail = " ".join(f"{status} {count}" for status, count in self.counts.items())
+        if self.retries:
+            detail += f" retries {self.retries}"
+        if self.bytes:
+            detail = f"{filesize.decimal(self.bytes)} {filesize.decimal(int(rate))}/s  {detail}"
+        self.progress.update(
+            self._progress_task,
+            total=max(self.total, done) or None,
+            completed=done,
+            detail=detail
+        )
+        self.progress.refresh()
+
+class Transport:
+    """HTTP 传输层接口：request 返回异步上下文管理器，产出的响应与 aiohttp.ClientResponse 的用法一致
+    （status、headers、content.iter_chunked、raise_for_status、text），错误统一为 aiohttp.ClientError / asyncio.TimeoutError
+    """
+    
+    name = ""
+    
+    def request(self, method: str, url: str, headers: Optional[dict] = None, proxy: Optional[str] = None,
+                proxy_auth: Optional[aiohttp.BasicAuth] = None, timeout: Optional[int] = None):
+        raise NotImplementedError
+    
+    async def close(self):
+        pass
+
+class AiohttpTransport(Transport):
+    """HTTP/1.1：使用共享的 aiohttp 会话及其连接池"""
+    
+    name = "aiohttp"
+    
+    def __init__(self, session: aiohttp.ClientSession):
+        self.session = session
+    
+    def request(self, method: str, url: str, headers: Optional[dict] = None, proxy: Optional[str] = None,
+                proxy_auth: Optional[aiohttp.BasicAuth] = None, timeout: Optional[int] = None):
+        kwargs = {"timeout": timeout} if timeout is not None else {}
+        return self.session.request(method, url, headers=headers, proxy=proxy, proxy_auth=proxy_auth, **kwargs)
+
+class Http2Response:
+    """把 httpx 流式响应包装成下载路径使用的 aiohttp 响应接口"""
     
-    "db_config": {
-        "host": "localhost",
-        "port": 3306,
-        "user": "root",
-        "password": "your_password",
-        "db": "image_downloader",
-        "charset": "utf8mb4"
-    },
+    def __init__(self, response: "httpx.Response"):
+        self._response = response
+        self.status = response.status_code
+        self.headers = response.headers
+        # response.content.iter_chunked(...) 与 aiohttp 写法一致
+        self.content = self
     
-    "content_filter": {
-        "min_size": [1200, 800],
-        "max_size": [3840, 2160],
-        "content_types": [
-            "image/jpeg",
-            "image/png",
-            "image/webp"
-        ]
-    },
+    def iter_chunked(self, size: int):
+        return self._response.aiter_bytes(size)
     
-    "logging": {
-        "level": "INFO",
-        "file": "logs/image_downloader.log",
-        "backup_count": 7,
-        "max_bytes": 10485760  # 10MB
-    }
-}
+    def raise_for_status(self):
+        if self.status < 400:
+            return
+        request = self._response.request
+        url = URL(str(request.url))
+        request_info = aiohttp.RequestInfo(url, request.method, CIMultiDictProxy(CIMultiDict(request.headers.items())), url)
+        raise aiohttp.ClientResponseError(
+            request_info, (),
+            status=self.status,
+            message=self._response.reason_phrase,
+            headers=CIMultiDictProxy(CIMultiDict(self.headers.items()))
+        )
+    
+    async def text(self) -> str:
+        await self._response.aread()
+        return self._response.text
 
-class ContentTypeNotAllowed(Exception):
-    """自定义异常：不允许的内容类型"""
-    pass
+class Http2Transport(Transport):
+    """HTTP/2（httpx）：同一主机的并发请求复用少量连接上的多路流，省去每个连接的 TCP+TLS 握手
+    
+    以下情况自动回退到 fallback（aiohttp）：请求使用代理；明文 http 且未开启 prior_knowledge；
+    服务器只协商到 HTTP/1.1 或出现协议错误的主机（记住后该主机后续请求都走 fallback）。
+    httpx 没有整体超时，timeout 作用于连接、读、写各阶段。
+    """
+    
+    name = "http2"
+    
+    def __init__(self, settings: dict, fallback: Transport, metrics: Optional["Metrics"] = None, **client_options):
+        self.prior_knowledge = settings["http2_prior_knowledge"]
+        self.fallback = fallback
+        self.metrics = metrics
+        # 缺少 h2 包时 httpx 在此抛出 ImportError
+        self.client = httpx.AsyncClient(http1=not self.prior_knowledge, http2=True, **client_options)
+        self.http1_hosts: set = set()
+    
+    def request(self, method: str, url: str, headers: Optional[dict] = None, proxy: Optional[str] = None,
+                proxy_auth: Optional[aiohttp.BasicAuth] = None, timeout: Optional[int] = None):
+        parsed = urlparse(url)
+        if proxy or parsed.netloc in self.http1_hosts or (parsed.scheme != "https" and not self.prior_knowledge):
+            return self.fallback.request(method, url, headers=headers, proxy=proxy, proxy_auth=proxy_auth, timeout=timeout)
+        return self._request(method, url, parsed.netloc, headers, timeout)
+    
+    @asynccontextmanager
+    async def _request(self, method: str, url: str, host: str, headers: Optional[dict], timeout: Optional[int]):
+        started = time.perf_counter()
+        try:
+            request = self.client.build_request(
+                method, url,
+                headers=headers,
+                timeout=httpx.Timeout(timeout) if timeout is not None else httpx.USE_CLIENT_DEFAULT
+            )
+            response = await self.client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            raise self._translate(e, host) from e
+        if self.metrics is not None:
+            self.metrics.observe("ttfb", host, time.perf_counter() - started)
+        if response.http_version != "HTTP/2":
+            # 服务器不支持 HTTP/2：本次照常使用，之后该主机走 aiohttp 连接池
+            self.http1_hosts.add(host)
+        try:
+            yield Http2Response(response)
+        except httpx.HTTPError as e:
+            raise self._translate(e, host) from e
+        finally:
+            await response.aclose()
+    
+    def _translate(self, error: Exception, host: str) -> Exception:
+        if isinstance(error, httpx.TimeoutException):
+            return asyncio.TimeoutError(str(error))
+        if isinstance(error, (httpx.RemoteProtocolError, httpx.LocalProtocolError)):
+            self.http1_hosts.add(host)
+        return aiohttp.ClientConnectionError(str(error) or type(error).__name__)
+    
+    async def close(self):
+        await self.client.aclose()
+
+def create_transport(config: dict, session: aiohttp.ClientSession, metrics: Optional["Metrics"] = None) -> Transport:
+    """按配置创建传输层；HTTP/2 依赖（httpx[http2]）缺失时回退到 aiohttp"""
+    transport = AiohttpTransport(session)
+    settings = config["transport"]
+    if settings["backend"] != "http2":
+        return transport
+    if httpx is None:
+        logger.warning("httpx is not installed, falling back to aiohttp (pip install 'httpx[http2]')")
+        return transport
+    try:
+        return Http2Transport(
+            settings,
+            fallback=transport,
+            metrics=metrics,
+            headers=config["headers"],
+            timeout=httpx.Timeout(config["timeout"]),
+            limits=httpx.Limits(
+                max_connections=config["threads"],
+                max_keepalive_connections=config["threads"],
+                keepalive_expiry=config["scheduler"]["keepalive_timeout"]
+            ),
+            follow_redirects=True,
+            trust_env=False
+        )
+    except ImportError as e:
+        logger.warning("HTTP/2 unavailable (%s), falling back to aiohttp", e)
+        return transport
 
 class ImageDownloader:
-    def __init__(self, config_path: str = CONFIG_FILE):
-        self.config = self.load_config(config_path)
+    def __init__(self, config_path: str = CONFIG_FILE, overrides: Optional[dict] = None):
+        self.config = self.load_config(config_path, overrides)
         self.session: Optional[aiohttp.ClientSession] = None
-        self.executor = ThreadPoolExecutor(max_workers=os.cpu_count() * 2)
-        self.db_pool: Optional[aiomysql.Pool] = None
-        self.proxy_pool = self.load_proxy_pool()
+        # 转码是CPU密集型任务，使用进程池绕开GIL
+        self.executor = ProcessPoolExecutor(max_workers=self.config["transcode"]["workers"] or os.cpu_count())
+        self.transcode_budget: Optional[ByteBudget] = None
+        # crawl_images 运行期间的下载流水线，转码阶段通过它移交给转码工作者
+        self.pipeline: Optional[DownloadPipeline] = None
+        self.storage = Storage(self.config["storage"])
+        self.fsync_batcher: Optional[FsyncBatcher] = None
+        if self.config["writer"]["fsync"] == "batch":
+            self.fsync_batcher = FsyncBatcher(self.config["writer"]["fsync_interval"])
+        self.store: StateStore = create_state_store(self.config)
+        self.proxy_manager = ProxyManager(self.config)
+        self.scheduler = HostScheduler(
+            self.config["threads"],
+            self.config["scheduler"]["per_host_limit"],
+            self.config["scheduler"]["adaptive"]
+        )
+        self.rate_limiter = RateLimiter(self.config["rate_limit"])
+        self.breaker = CircuitBreaker(self.config["circuit_breaker"])
+        self.parser = self.config["extractor"]["parser"]
+        if self.parser == "auto":
+            self.parser = "lxml" if lxml is not None else "html.parser"
+        # lxml 解析时释放GIL，线程池即可；html.parser 需要进程池才能并行
+        executor_class = ProcessPoolExecutor if self.config["extractor"]["use_processes"] else ThreadPoolExecutor
+        self.parse_executor = executor_class(max_workers=self.config["extractor"]["workers"])
+        self.metrics = Metrics(self.config["metrics"]["enabled"])
+        self.record_writer: Optional[RecordWriter] = None
+        self.hash_writer: Optional[RecordWriter] = None
+        self.derivative_writer: Optional[RecordWriter] = None
+        # 本次运行内的内容哈希 -> 路径缓存
+        self.hash_index: Dict[str, str] = {}
+        # 正在处理（尚未落盘）的内容哈希 -> 完成后的最终路径，失败时为 None
+        self.hash_pending: Dict[str, asyncio.Future] = {}
+        self.log_listener: Optional[QueueListener] = None
+        self.log_handler: Optional[QueueHandler] = None
+        log_config = self.config["logging"]
+        self.progress = ProgressReporter(not log_config["quiet"], log_config["progress_interval"])
     
     async def __aenter__(self):
+        # 长连接复用 + DNS缓存，连接数与调度器上限保持一致
+        connector = aiohttp.TCPConnector(
+            limit=self.config["threads"],
+            limit_per_host=self.config["scheduler"]["per_host_limit"],
+            ttl_dns_cache=self.config["scheduler"]["dns_cache_ttl"],
+            keepalive_timeout=self.config["scheduler"]["keepalive_timeout"]
+        )
         self.session = aiohttp.ClientSession(
+            connector=connector,
             headers=self.config["headers"],
-            timeout=aiohttp.ClientTimeout(total=self.config["timeout"])
+            timeout=aiohttp.ClientTimeout(total=self.config["timeout"]),
+            trace_configs=[self.metrics.trace_config()] if self.metrics.enabled else None
         )
-        self.db_pool = await aiomysql.create_pool(**self.config["db_config"])
+        self.transport = create_transport(self.config, self.session, self.metrics if self.metrics.enabled else None)
+        if self.metrics.enabled and self.config["metrics"]["port"]:
+            await self.metrics.start_server(self.config["metrics"]["port"])
+        await self.store.open()
+        await self.proxy_manager.start()
+        self.transcode_budget = ByteBudget(self.config["transcode"]["max_inflight_bytes"])
+        self.record_writer = self.create_record_writer(self.write_records)
+        self.hash_writer = self.create_record_writer(self.store.save_hashes)
+        self.derivative_writer = self.create_record_writer(self.store.save_derivatives)
+        if self.fsync_batcher is not None:
+            self.fsync_batcher.start()
+        self.progress.start()
         return self
     
+    def create_record_writer(self, flush_func) -> RecordWriter:
+        """按 record_writer 配置创建并启动后台批量写入器，各类记录共用同一组批量参数"""
+        settings = self.config["record_writer"]
+        writer = RecordWriter(
+            flush_func,
+            batch_size=settings["batch_size"],
+            flush_interval=settings["flush_interval"],
+            max_queue=settings["max_queue"],
+            max_retries=settings["max_retries"],
+            retry_delay=settings["retry_delay"]
+        )
+        writer.start()
+        return writer
+    
     async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.progress.close()
+        await self.record_writer.close()
+        await self.hash_writer.close()
+        await self.derivative_writer.close()
+        await self.storage.close()
+        if self.fsync_batcher is not None:
+            await self.fsync_batcher.close()
+        await self.transport.close()
         await self.session.close()
-        self.db_pool.close()
-        await self.db_pool.wait_closed()
+        await self.proxy_manager.close()
+        await self.store.close()
         self.executor.shutdown(wait=True)
+        self.parse_executor.shutdown(wait=True)
+        await self.metrics.stop_server()
+        if self.metrics.enabled and self.config["metrics"]["summary"] and self.metrics.histograms:
+            console.print(self.metrics.summary_table())
+        breaker_table = self.breaker.summary_table()
+        if breaker_table is not None:
+            console.print(breaker_table)
         console.print("\n[bold]Resources released successfully[/bold]")
+        self.stop_logging()
     
-    async def save_image_record(self, url: str, path: str, status: str):
-        """异步保存图片记录（使用连接池）"""
-        async with self.db_pool.acquire() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("""
-                    INSERT INTO images (url, path, status)
-                    VALUES (%s, %s, %s)
-                    ON DUPLICATE KEY UPDATE status = VALUES(status)
-                """, (url, path, status))
-                await conn.commit()
-    
-    async def download_image(self, url: str, folder: str, sem: asyncio.Semaphore):
-        """优化重试逻辑和错误处理"""
-        async with sem:
-            retry_delay = 1
-            for attempt in range(1, self.config["max_retries"] + 1):
-                try:
-                    async with self.session.get(
-                        url,
-                        headers=self.config["headers"],
-                        proxy=await self.get_proxy(),
-                        timeout=self.config["timeout"]
-                    ) as response:
-                        
-                        if response.status == 206 and self.config["auto_resume"]:
-                            total = int(response.headers.get("Content-Length", 0))
-                            resume_byte = self.get_resume_byte(url)
-                            if resume_byte > 0:
-                                headers = self.config["headers"].copy()
-                                headers["Range"] = f"bytes={resume_byte}-"
-                                continue
-                        
-                        response.raise_for_status()
-                        
-                        content_type = response.headers.get("Content-Type", "")
-                        if content_type not in self.config["valid_content_types"]:
-                            raise ContentTypeNotAllowed(content_type)
-                        
-                        content_length = int(response.headers.get("Content-Length", 0))
-                        if content_length < self.config["content_filter"]["min_size"][0] * 1024:
-                            raise ValueError(f"Image too small ({content_length/1024:.1f}KB)")
-                        
-                        filename = f"{hashlib.md5(url.encode()).hexdigest()[:8]}_{os.path.basename(urlparse(url).path)}"
-                        filepath = os.path.join(folder, filename)
-                        
-                        mode = "ab" if self.config["auto_resume"] and resume_byte > 0 else "wb"
-                        async with aiofiles.open(filepath, mode) as f:
-                            async for chunk in response.content.iter_chunked(8192):
-                                await f.write(chunk)
-                        
-                        if content_type.startswith("image/"):
-                            await self.process_image(filepath)
-                        
-                        await self.save_image_record(url, filepath, "completed")
-                        console.print(f"[green]Downloaded: {url}[/green]")
+    async def save_image_record(self, url: str, path: str, status: str,
+                                etag: Optional[str] = None, last_modified: Optional[str] = None,
+                                content_length: Optional[int] = None):
+        """异步保存图片记录（交给后台批量写入）"""
+        self.metrics.inc("images_total", status=status)
+        self.progress.count(status)
+        with self.metrics.timer("db_enqueue"):
+            await self.record_writer.put((url, path, status, etag, last_modified, content_length))
+    
+    async def write_records(self, rows: List[tuple]):
+        """批量写入图片记录（由 RecordWriter 后台调用）"""
+        with self.metrics.timer("db_flush"):
+            await self.store.save_records(rows)
+    
+    async def download_image(self, url: str, folder: str):
+        """获取主机槽位后下载单张图片"""
+        async with self.scheduler.slot(urlparse(url).netloc):
+            await self.fetch_image(url, folder)
+    
+    async def fetch_image(self, url: str, folder: str):
+        """在已获得的主机槽位内下载单张图片：重试、续传、条件请求和错误处理"""
+        filename = f"{hashlib.md5(url.encode()).hexdigest()[:8]}_{os.path.basename(urlparse(url).path)}"
+        filepath = os.path.join(folder, filename)
+        partial_path = filepath + ".part"
+        host = urlparse(url).netloc
+        previous = await self.get_previous_record(url) if self.config["conditional_recrawl"] else None
+        
+        for attempt in range(1, self.config["max_retries"] + 1):
+            if not await self.breaker.allow(host):
+                # 主机熔断中：不占用重试次数，记为推迟，下次运行（或导入）时重新下载
+                await self.save_image_record(url, "", "deferred")
+                break
+            try:
+                proxy, response_received = None, False
+                headers = self.config["headers"].copy()
+                resume_byte, manifest = 0, {}
+                if self.config["auto_resume"]:
+                    resume_byte, manifest = self.get_resume_byte(partial_path)
+                    if resume_byte > 0:
+                        headers["Range"] = f"bytes={resume_byte}-"
+                        headers["If-Range"] = manifest["etag"] or manifest["last_modified"]
+                if resume_byte == 0 and previous:
+                    # 条件请求：资源未变化时服务器返回304
+                    if previous["etag"]:
+                        headers["If-None-Match"] = previous["etag"]
+                    if previous["last_modified"]:
+                        headers["If-Modified-Since"] = previous["last_modified"]
+                
+                await self.rate_limiter.acquire(host)
+                proxy = await self.get_proxy()
+                started = asyncio.get_running_loop().time()
+                async with self.transport.request(
+                    "GET", url,
+                    headers=headers,
+                    proxy=proxy,
+                    proxy_auth=self.proxy_manager.auth,
+                    timeout=self.config["timeout"]
+                ) as response:
+                    response_received = True
+                    elapsed = asyncio.get_running_loop().time() - started
+                    self.proxy_manager.report(proxy, True, elapsed)
+                    self.breaker.record(host, response.status < 500)
+                    if response.status in (429, 503):
+                        self.scheduler.feedback(host, False)
+                        self.rate_limiter.throttled(host, response.headers.get("Retry-After"))
+                        self.metrics.inc("throttled_total", host=host)
+                    elif response.status < 500:
+                        self.scheduler.feedback(host, True, elapsed)
+                    
+                    if response.status == 416 and resume_byte > 0:
+                        # 断点已失效，丢弃分片后从头下载
+                        self.discard_partial(partial_path)
+                        raise aiohttp.ClientError(f"Range not satisfiable, restarting: {url}")
+                    
+                    if response.status == 304 and previous:
+                        await self.save_image_record(url, previous["path"], "not_modified")
+                        logger.debug("Not modified: %s", url)
                         return
                     
-                except ContentTypeNotAllowed as e:
-                    console.print(f"[red]{e}[/red]")
-                    await self.save_image_record(url, "", "blocked")
-                    break
-                except aiohttp.ClientError as e:
-                    if attempt == self.config["max_retries"]:
-                        console.print(f"[red]Max retries exceeded: {str(e)}[/red]")
-                        await self.save_image_record(url, "", "failed")
+                    response.raise_for_status()
+                    
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+                    if response.status == 206 and manifest.get("etag") and etag != manifest["etag"]:
+                        self.discard_partial(partial_path)
+                        raise aiohttp.ClientError(f"Resource changed during resume, restarting: {url}")
+                    if response.status != 206:
+                        # 服务器返回完整内容（资源已变化或不支持Range），从头写入
+                        resume_byte = 0
+                    
+                    content_type = response.headers.get("Content-Type", "")
+                    if content_type.split(";")[0].strip().lower() not in self.config["content_filter"]["content_types"]:
+                        raise ContentTypeNotAllowed(content_type)
+                    
+                    manifest = {
+                        "url": url,
+                        "bytes": resume_byte,
+                        "etag": etag,
+                        "last_modified": last_modified
+                    }
+                    # 续传时图片头部已在首次下载时检查过
+                    sniffer = None
+                    is_image = content_type.startswith("image/")
+                    if resume_byte == 0 and is_image:
+                        content_filter = self.config["content_filter"]
+                        sniffer = DimensionSniffer(
+                            content_filter["min_size"],
+                            content_filter["max_size"],
+                            content_filter["sniff_bytes"]
+                        )
+                    
+                    # 启用断点续传时所有图片都写入 .part 分片，中断后才能续传
+                    inline_size = int(response.headers.get("Content-Length", 0)) if sniffer else 0
+                    if not self.config["auto_resume"] and 0 < inline_size <= self.config["transcode"]["max_inline_bytes"]:
+                        # 小图片直接读入内存交给转码进程，只写一次最终文件；预算不足时在此等待
+                        async with self.transcode_budget.reserve(inline_size) as lease:
+                            with self.metrics.timer("transfer", host):
+                                data, sha256 = await self.read_stream(response, sniffer, host)
+                            manifest["bytes"] = len(data)
+                            await self.finish_download(url, filepath, partial_path, sha256, data, is_image, manifest, lease)
                     else:
-                        console.print(f"[yellow]Retry {attempt}/{self.config['max_retries']}: {str(e)}[/yellow]")
-                        await asyncio.sleep(retry_delay * 2 ** (attempt - 1))
-                        retry_delay = min(retry_delay * 2, 30)
-                except ValueError as e:
-                    console.print(f"[red]{str(e)}[/red]")
-                    await self.save_image_record(url, "", "invalid")
-                    break
-                except Exception as e:
-                    console.print(f"[red]Unexpected error: {str(e)}[/red]")
-                    await self.save_image_record(url, "", "error")
+                        with self.metrics.timer("transfer", host):
+                            sha256 = await self.write_stream(response, partial_path, manifest, sniffer, host)
+                        await self.finish_download(url, filepath, partial_path, sha256, None, is_image, manifest)
+                    return
+                
+            except ContentTypeNotAllowed as e:
+                logger.info("Blocked content type %s: %s", e, url)
+                await self.save_image_record(url, "", "blocked")
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not response_received:
+                    self.proxy_manager.report(proxy, False)
+                    self.breaker.record(host, False)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.scheduler.feedback(host, False)
+                status = e.status if isinstance(e, aiohttp.ClientResponseError) else None
+                if status is not None and 400 <= status < 500 and status not in (408, 429):
+                    # 客户端错误重试也不会成功，直接记为失败
+                    logger.info("Failed: %s: %s", url, e)
+                    await self.save_image_record(url, "", "failed")
                     break
+                if attempt == self.config["max_retries"]:
+                    logger.info("Max retries exceeded: %s: %s", url, e)
+                    await self.save_image_record(url, "", "failed")
+                else:
+                    logger.info("Retry %d/%d: %s: %s", attempt, self.config["max_retries"], url, e)
+                    self.progress.retry()
+                    if status in (429, 503):
+                        # 主机已按 Retry-After 暂停，下次 acquire 时等待；抖动避免暂停结束时集中请求
+                        await asyncio.sleep(random.uniform(0, self.config["rate_limit"]["backoff_base"]))
+                    else:
+                        await asyncio.sleep(self.rate_limiter.backoff(attempt))
+            except ValueError as e:
+                logger.info("Rejected: %s: %s", url, e)
+                self.discard_partial(partial_path)
+                await self.save_image_record(url, "", "invalid")
+                break
+            except Exception as e:
+                logger.exception("Unexpected error: %s: %s", url, e)
+                await self.save_image_record(url, "", "error")
+                break
+        
+        # 成功时已在循环内返回，到这里表示最终失败；未启用断点续传时分片不会再被利用，不留在输出目录
+        if not self.config["auto_resume"]:
+            self.discard_partial(partial_path)
+    
+    async def finish_download(self, url: str, filepath: str, partial_path: str, sha256: str,
+                              data: Optional[bytes], is_image: bool, manifest: dict,
+                              lease: Optional[_BudgetLease] = None):
+        """去重、转码并保存记录；data 为内存中的完整内容，None 表示内容在分片文件中
+        
+        流水线运行时转码和记录交给转码阶段，lease 持有的内存预算随任务一起转交
+        """
+        validators = (manifest["etag"], manifest["last_modified"], manifest["bytes"])
+        self.metrics.inc("bytes_total", manifest["bytes"], host=urlparse(url).netloc)
+        self.progress.add_bytes(manifest["bytes"])
+        if is_image and not self.config["derivatives"]["keep_original"]:
+            ext = FORMAT_EXTENSIONS[self.config["image_compression"]["format"]]
+        else:
+            ext = os.path.splitext(filepath)[1]
+        filepath = self.storage.final_path(filepath, sha256, ext)
+        if self.config["dedup"]["enabled"]:
+            existing = await self.find_duplicate(sha256)
+            if existing:
+                record = await self.store.get_record(url)
+                if record is not None and record["status"] in ("completed", "not_modified") and record["path"] == existing:
+                    # 重复的是本URL自己上次保存的文件（服务器不提供校验器时的重新抓取）：内容未变化
+                    self.discard_partial(partial_path)
+                    await self.save_image_record(url, existing, "not_modified", *validators)
+                    logger.debug("Unchanged: %s", url)
+                    return
+                # 内容重复：不保存第二份，也不再转码
+                path = self.link_duplicate(existing, partial_path, filepath)
+                await self.save_image_record(url, path, "duplicate", *validators)
+                logger.debug("Duplicate of %s: %s", existing, url)
+                return
+            # 本次运行中首次出现该内容：文件写完（转码、打包）后才登记，期间同内容的下载等待它的结果
+            self.hash_pending[sha256] = asyncio.get_running_loop().create_future()
+        
+        try:
+            if data is None:
+                os.replace(partial_path, filepath)
+                self.discard_partial(partial_path)
+            
+            source = data if data is not None else filepath
+            if is_image and self.pipeline is not None:
+                await self.pipeline.transcode(url, source, filepath, validators, sha256, lease.take() if lease else 0)
+                return
+        except BaseException:
+            self.resolve_pending_hash(sha256, None)
+            raise
+        await self.complete_image(url, source if is_image else None, filepath, validators, sha256)
     
-    def get_resume_byte(self, url: str) -> int:
-        """获取已下载字节数（示例占位，需根据实际情况实现）"""
-        return 0
+    async def complete_image(self, url: str, source, filepath: str, validators: tuple, sha256: str):
+        """转码（source 为 None 时跳过）并保存完成记录"""
+        try:
+            derivatives = await self.process_image(source, filepath) if source is not None else []
+            if self.storage.pack:
+                filepath = await self.storage.pack_file(filepath, url)
+                derivatives = [(name, await self.storage.pack_file(path, url), width, height)
+                               for name, path, width, height in derivatives]
+            elif self.fsync_batcher is not None:
+                self.fsync_batcher.add(filepath)
+                for _, path, _, _ in derivatives:
+                    self.fsync_batcher.add(path)
+            if self.config["dedup"]["enabled"]:
+                # 文件已经落盘（或进入包），此时登记内容哈希
+                self.hash_index[sha256] = filepath
+                await self.hash_writer.put((sha256, filepath))
+        except BaseException:
+            self.resolve_pending_hash(sha256, None)
+            raise
+        self.resolve_pending_hash(sha256, filepath)
+        for name, path, width, height in derivatives:
+            await self.derivative_writer.put((url, name, path, width, height))
+        await self.save_image_record(url, filepath, "completed", *validators)
+        logger.debug("Downloaded: %s", url)
+    
+    async def read_stream(self, response: aiohttp.ClientResponse,
+                          sniffer: Optional[DimensionSniffer] = None, host: str = "") -> Tuple[bytes, str]:
+        """把响应内容读入内存，返回 (内容, SHA-256)"""
+        digest = hashlib.sha256()
+        buffer = bytearray()
+        async for chunk in response.content.iter_chunked(65536):
+            if sniffer is not None and not sniffer.done:
+                sniffer.feed(chunk)
+            digest.update(chunk)
+            buffer += chunk
+            await self.rate_limiter.consume(host, len(chunk))
+        return bytes(buffer), digest.hexdigest()
     
-    async def process_image(self, filepath: str):
-        """异步图片处理"""
+    async def get_previous_record(self, url: str) -> Optional[dict]:
+        """返回可用于条件请求的历史记录（已完成、文件仍在且带有校验器）"""
+        record = await self.store.get_record(url)
+        if (
+            record is None
+            or record["status"] not in DONE_STATUSES
+            or not (record["etag"] or record["last_modified"])
+            or not self.storage.exists(record["path"])
+        ):
+            return None
+        return record
+    
+    async def write_stream(self, response: aiohttp.ClientResponse, partial_path: str, manifest: dict,
+                           sniffer: Optional[DimensionSniffer] = None, host: str = "") -> str:
+        """流式写入分片文件，定期把已落盘字节数记录到旁路清单，返回内容的SHA-256
+        
+        传入 sniffer 时用开头的数据块检查像素尺寸，不符合则立即中止传输
+        """
+        checkpoint_bytes = self.config["resume"]["checkpoint_bytes"]
+        next_checkpoint = manifest["bytes"] + checkpoint_bytes
+        self.save_resume_manifest(partial_path, manifest)
+        
+        settings = self.config["writer"]
         loop = asyncio.get_running_loop()
-        await loop.run_in_executor(
-            self.executor,
-            self._sync_process_image,
-            filepath
+        digest = hashlib.sha256()
+        if manifest["bytes"] > 0:
+            # 续传时先把已有部分计入哈希
+            await loop.run_in_executor(None, hash_file_prefix, digest, partial_path, manifest["bytes"])
+        writer = PartFileWriter(
+            partial_path,
+            offset=manifest["bytes"],
+            expected_size=manifest["bytes"] + int(response.headers.get("Content-Length", 0)),
+            min_chunk=settings["min_chunk"],
+            max_chunk=settings["max_chunk"],
+            preallocate=settings["preallocate"]
         )
+        await writer.open()
+        try:
+            async for chunk in response.content.iter_chunked(65536):
+                if sniffer is not None and not sniffer.done:
+                    sniffer.feed(chunk)
+                digest.update(chunk)
+                await writer.write(chunk)
+                await self.rate_limiter.consume(host, len(chunk))
+                if writer.size >= next_checkpoint:
+                    await writer.flush()
+                    manifest["bytes"] = writer.position
+                    self.save_resume_manifest(partial_path, manifest)
+                    next_checkpoint = writer.position + checkpoint_bytes
+        finally:
+            # 中断时也写入已收到的数据并记录最终进度，下次从这里续传
+            try:
+                await writer.close(fsync=settings["fsync"] == "file")
+            finally:
+                manifest["bytes"] = writer.position
+                self.save_resume_manifest(partial_path, manifest)
+        self.metrics.inc("write_calls_total", writer.writes)
+        return digest.hexdigest()
+    
+    def resolve_pending_hash(self, sha256: str, path: Optional[str]):
+        """首个下载完成（path 为最终路径）或失败（None）后，唤醒等待同内容的下载"""
+        pending = self.hash_pending.pop(sha256, None)
+        if pending is not None and not pending.done():
+            pending.set_result(path)
+    
+    async def find_duplicate(self, sha256: str) -> Optional[str]:
+        """按内容哈希查找已保存的文件路径；同内容的首个下载仍在处理中时等待其结果
+        
+        返回 None 时调用方与登记 hash_pending 之间没有 await，不会有两个下载同时成为首个
+        """
+        while True:
+            pending = self.hash_pending.get(sha256)
+            if pending is not None:
+                path = await asyncio.shield(pending)
+                if path is not None:
+                    return path
+                continue
+            path = self.hash_index.get(sha256)
+            if path is None:
+                path = await self.store.lookup_hash(sha256)
+                if sha256 in self.hash_pending:
+                    # 查询期间同内容的另一个下载已登记
+                    continue
+                if path is not None:
+                    self.hash_index[sha256] = path
+            if path and self.storage.exists(path):
+                return path
+            return None
+    
+    def link_duplicate(self, existing: str, partial_path: str, filepath: str) -> str:
+        """用硬链接代替重复文件，无法链接时只在记录中引用已有文件"""
+        self.discard_partial(partial_path)
+        if self.config["dedup"]["link"] == "hardlink" and os.path.abspath(existing) != os.path.abspath(filepath):
+            try:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                os.link(existing, filepath)
+                return filepath
+            except OSError:
+                pass
+        return existing
+    
+    def get_resume_byte(self, partial_path: str) -> Tuple[int, dict]:
+        """读取旁路清单，返回可续传的字节偏移和清单内容"""
+        manifest_path = partial_path + ".json"
+        if not os.path.exists(partial_path) or not os.path.exists(manifest_path):
+            return 0, {}
+        try:
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return 0, {}
+        
+        # 弱ETag不能用于If-Range，没有可用校验器时无法安全续传
+        etag = manifest.get("etag")
+        if etag and etag.startswith("W/"):
+            manifest["etag"] = etag = None
+        if not etag and not manifest.get("last_modified"):
+            return 0, {}
+        
+        # 以清单记录和实际文件大小中较小者为准
+        resume_byte = min(int(manifest.get("bytes", 0)), os.path.getsize(partial_path))
+        return resume_byte, manifest
+    
+    def save_resume_manifest(self, partial_path: str, manifest: dict):
+        """保存分片文件的旁路清单（只在启用断点续传时需要）"""
+        if not self.config["auto_resume"]:
+            return
+        with open(partial_path + ".json", "w") as f:
+            json.dump(manifest, f)
+    
+    def discard_partial(self, partial_path: str):
+        """删除分片文件及其清单"""
+        for path in (partial_path, partial_path + ".json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
     
-    def _sync_process_image(self, filepath: str):
-        """同步图片处理"""
+    async def process_image(self, source, filepath: str) -> List[tuple]:
+        """异步图片处理（进程池转码）；source 为图片内容或文件路径，返回生成的衍生图列表"""
+        loop = asyncio.get_running_loop()
+        compression = self.config["image_compression"]
+        derivatives = self.config["derivatives"]
         try:
-            with Image.open(filepath) as img:
-                img = img.convert("RGB")
-                img.save(
+            with self.metrics.timer("transcode"):
+                return await loop.run_in_executor(
+                    self.executor,
+                    transcode_image,
+                    source,
                     filepath,
-                    format=self.config["image_compression"]["format"],
-                    quality=self.config["image_compression"]["quality"],
-                    lossless=self.config["image_compression"]["lossless"]
+                    compression["format"],
+                    compression["quality"],
+                    compression["lossless"],
+                    self.config["writer"]["fsync"] == "file",
+                    derivatives["sizes"],
+                    derivatives["keep_original"]
                 )
         except Exception as e:
-            console.print(f"[yellow]Compression failed: {str(e)}[/yellow]")
+            logger.warning("Compression failed: %s: %s", filepath, e)
+            if isinstance(source, bytes) and not os.path.exists(filepath):
+                async with aiofiles.open(filepath, "wb") as f:
+                    await f.write(source)
+            return []
     
-    async def crawl_images(self, url: str, folder: str):
-        """网页图片抓取"""
+    async def crawl_images(self, url: str, folder: str,
+                           sink: Optional[Callable[[List[str]], Awaitable[Any]]] = None,
+                           frontier_file: Optional[str] = None):
+        """网页图片抓取：从起始页按深度遍历，下载发现的图片
+        
+        传入 sink 时只把发现的图片URL批量交给 sink（如分布式队列），不在本进程下载；
+        frontier_file 为空时使用 crawl.frontier_file，其他模式传入各自的断点文件，互不恢复对方的进度
+        """
+        os.makedirs(folder, exist_ok=True)
+        if frontier_file is None:
+            frontier_file = self.config["crawl"]["frontier_file"]
+        frontier = CrawlFrontier(url, {**self.config["crawl"], "frontier_file": frontier_file})
+        if frontier.load():
+            console.print(f"[cyan]Resuming crawl: {frontier.pages_crawled} pages done[/cyan]")
+        else:
+            frontier.add_page(url, 0)
+        
+        loop = asyncio.get_running_loop()
+        last_checkpoint = loop.time()
+        pipeline = None
+        if sink is None:
+            pipeline = DownloadPipeline(self, folder, on_done=lambda image_url: frontier.images_done([image_url]))
+            pipeline.start()
         try:
-            async with self.session.get(url) as response:
-                response.raise_for_status()
-                html = await response.text()
-            
-            soup = BeautifulSoup(html, "html.parser")
-            
-            img_tags = soup.find_all("img")
-            direct_urls = [
-                urljoin(url, img.get("src") or img.get("data-src"))
-                for img in img_tags
-                if img.get("src") or img.get("data-src")
-            ]
-            
-            link_tags = soup.find_all("a", href=True)
-            link_urls = [urljoin(url, link["href"]) for link in link_tags if link["href"]]
-            
-            seen = set()
-            all_urls = []
-            for url in direct_urls + link_urls:
-                parsed = urlparse(url)
-                normalized = f"{parsed.scheme}://{parsed.netloc}{parsed.path}"
-                if normalized not in seen and self.is_valid_url(url):
-                    seen.add(normalized)
-                    all_urls.append(normalized)
-            
-            os.makedirs(folder, exist_ok=True)
+            while True:
+                item = frontier.next_page()
+                if item is not None:
+                    depth, page_url = item
+                    try:
+                        image_urls, page_urls = await self.fetch_page(page_url)
+                    except Exception as e:
+                        logger.warning("Crawling failed: %s: %s", page_url, e)
+                        image_urls, page_urls = [], []
+                    for image_url in image_urls:
+                        frontier.add_image(image_url)
+                    for link in page_urls:
+                        frontier.add_page(link, depth + 1)
+                
+                batch = frontier.take_images()
+                if batch:
+                    if sink is not None:
+                        await sink(batch)
+                        frontier.images_done(batch)
+                    else:
+                        # 队列满时在此等待，页面发现的速度不会超过下载速度
+                        for image_url in batch:
+                            await pipeline.put(image_url)
+                elif item is None:
+                    break
+                
+                if loop.time() - last_checkpoint >= self.config["crawl"]["checkpoint_interval"]:
+                    await frontier.checkpoint()
+                    last_checkpoint = loop.time()
+            if pipeline is not None:
+                await pipeline.close()
+        except BaseException:
+            if pipeline is not None:
+                await pipeline.abort()
+            # 异常退出时保存进度（包括未完成的图片），下次从断点继续
+            frontier.save()
+            raise
+        
+        frontier.clear()
+    
+    async def ingest_urls(self, path: str, folder: str, fmt: Optional[str] = None):
+        """导入URL列表（文件或标准输入）直接下载，跳过已完成的URL，定期保存输入偏移以便中断后续读"""
+        os.makedirs(folder, exist_ok=True)
+        settings = self.config["ingest"]
+        reader = UrlListReader(path, fmt or settings["format"], settings["csv_column"])
+        checkpoint_file = settings["checkpoint_file"] if reader.seekable else ""
+        input_path = os.path.abspath(path)
+        
+        offset = 0
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            try:
+                with open(checkpoint_file, "r") as f:
+                    state = json.load(f)
+                if state["input"] == input_path:
+                    offset = state["offset"]
+                    console.print(f"[cyan]Resuming ingest at byte {offset}[/cyan]")
+            except (OSError, ValueError, KeyError) as e:
+                console.print(f"[yellow]Ingest checkpoint ignored: {str(e)}[/yellow]")
+        
+        def save_checkpoint():
+            if not checkpoint_file:
+                return
+            checkpoint_dir = os.path.dirname(checkpoint_file)
+            if checkpoint_dir:
+                os.makedirs(checkpoint_dir, exist_ok=True)
+            with open(checkpoint_file + ".tmp", "w") as f:
+                json.dump({"input": input_path, "offset": watermark.value(reader.offset)}, f)
+            os.replace(checkpoint_file + ".tmp", checkpoint_file)
+        
+        # 在途URL -> 行偏移；同一URL在途时重复出现的行直接跳过
+        in_flight: Dict[str, int] = {}
+        watermark = OffsetWatermark()
+        
+        def done(url: str):
+            watermark.finish(in_flight.pop(url))
+        
+        loop = asyncio.get_running_loop()
+        last_checkpoint = loop.time()
+        queued = skipped = 0
+        reader.open(offset)
+        pipeline = DownloadPipeline(self, folder, on_done=done)
+        pipeline.start()
+        try:
+            while True:
+                batch = await loop.run_in_executor(None, reader.read_batch, settings["batch_size"])
+                if not batch:
+                    break
+                urls = list({url for _, url in batch if url and self.is_valid_url(url)})
+                completed = await self.store.completed_urls(urls)
+                for line_offset, url in batch:
+                    if not url or not self.is_valid_url(url) or url in completed or url in in_flight:
+                        skipped += 1
+                        continue
+                    in_flight[url] = line_offset
+                    watermark.start(line_offset)
+                    await pipeline.put(url)
+                    queued += 1
+                
+                if loop.time() - last_checkpoint >= settings["checkpoint_interval"]:
+                    save_checkpoint()
+                    last_checkpoint = loop.time()
+            await pipeline.close()
+        except BaseException:
+            await pipeline.abort()
+            save_checkpoint()
+            raise
+        finally:
+            reader.close()
+        
+        if checkpoint_file and os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+        console.print(f"[bold]Ingest finished: {queued} queued, {skipped} skipped[/bold]")
+    
+    def frontier_file_for(self, mode: str) -> str:
+        """各运行模式的抓取断点文件：crawl 使用 crawl.frontier_file，其他模式在文件名中加上模式名"""
+        path = self.config["crawl"]["frontier_file"]
+        if not path or mode == "crawl":
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.{mode}{ext}"
+    
+    async def run_coordinator(self, start_url: str, queue: JobQueue):
+        """协调者：抓取页面发现图片，把图片URL放入共享队列
+        
+        启动时清除上一轮的结束标记，否则工作者会把空队列误判为已完成；
+        续抓时保留队列中的任务（这些URL在抓取进度中已记为交付），重新开始时清空
+        """
+        frontier_file = self.frontier_file_for("coordinator")
+        await queue.reset(keep_jobs=bool(frontier_file) and os.path.exists(frontier_file))
+        await self.crawl_images(start_url, ".", sink=queue.put, frontier_file=frontier_file)
+        await queue.mark_finished()
+        console.print("[bold]URL discovery finished[/bold]")
+    
+    async def run_worker(self, queue: JobQueue, folder: str, worker_index: int = 0, worker_count: int = 1):
+        """工作者：从共享队列拉取分到本节点的分片，执行下载/转码，完成后确认"""
+        os.makedirs(folder, exist_ok=True)
+        shards = [shard for shard in range(queue.shards) if shard % worker_count == worker_index]
+        if not shards:
+            raise ValueError(f"No shards for worker {worker_index}/{worker_count}, increase distributed.shards")
+        poll_interval = self.config["distributed"]["poll_interval"]
+        
+        async def consume(offset: int):
+            # 不同消费者从不同分片开始轮询，减少争用
+            order = shards[offset % len(shards):] + shards[:offset % len(shards)]
+            while True:
+                job = await queue.get(order)
+                if job is None:
+                    if await queue.is_drained():
+                        return
+                    await queue.requeue_expired()
+                    await asyncio.sleep(poll_interval)
+                    continue
+                self.progress.add()
+                await self.download_image(queue.url_of(job), folder)
+                await queue.ack(job)
+        
+        await asyncio.gather(*(consume(i) for i in range(self.config["threads"])))
+    
+    async def discover(self, start_url: str, manifest_path: str):
+        """预探测：按 crawl_images 遍历页面，但只探测发现的图片，不下载正文
+        
+        每张图片一行写入 JSONL 清单（url、状态码、类型、长度、尺寸、是否通过内容过滤），
+        清单可直接作为 ingest 的输入，accepted 为 false 的行会被跳过。
+        """
+        manifest_dir = os.path.dirname(manifest_path)
+        if manifest_dir:
+            os.makedirs(manifest_dir, exist_ok=True)
+        # 断点文件跟随清单，从断点继续时追加到已有清单
+        frontier_file = f"{manifest_path}.frontier.json" if self.config["crawl"]["frontier_file"] else ""
+        resuming = bool(frontier_file) and os.path.exists(frontier_file) and os.path.exists(manifest_path)
+        mode = "a" if resuming else "w"
+        if not resuming and frontier_file:
+            # 清单已不在时断点无效（已探测的行随清单丢失），重新开始
+            for path in (frontier_file, frontier_file + ".bloom"):
+                if os.path.exists(path):
+                    os.remove(path)
+        # 内容类型 -> [图片数, 通过数, 通过的字节数]
+        totals: Dict[str, List[int]] = defaultdict(lambda: [0, 0, 0])
+        
+        async with aiofiles.open(manifest_path, mode) as f:
+            async def probe_batch(urls: List[str]):
+                self.progress.add(len(urls))
+                rows = await asyncio.gather(*(self.probe_image(url) for url in urls))
+                await f.write("".join(json.dumps(row) + "\n" for row in rows))
+                for row in rows:
+                    self.progress.count({True: "accepted", False: "rejected"}.get(row["accepted"], "unknown"))
+                    total = totals[row["content_type"] or "-"]
+                    total[0] += 1
+                    if row["accepted"]:
+                        total[1] += 1
+                        total[2] += row["length"] or 0
             
-            sem = asyncio.Semaphore(self.config["threads"])
-            tasks = [self.download_image(url, folder, sem) for url in all_urls]
-            await asyncio.gather(*tasks)
+            await self.crawl_images(start_url, ".", sink=probe_batch, frontier_file=frontier_file)
         
-        except Exception as e:
-            console.print(f"[red]Crawling failed: {str(e)}[/red]")
+        table = Table(title=f"Discovered images ({manifest_path})")
+        table.add_column("Content-Type")
+        table.add_column("Images", justify="right")
+        table.add_column("Accepted", justify="right")
+        table.add_column("MB", justify="right")
+        for content_type, (count, accepted, size) in sorted(totals.items()):
+            table.add_row(content_type, str(count), str(accepted), f"{size / 1048576:.1f}")
+        console.print(table)
+    
+    async def probe_image(self, url: str) -> dict:
+        """用 HEAD（不支持时回退到范围 GET）或只读头部的范围 GET 探测单张图片
+        
+        accepted 为 True/False 表示通过/未通过内容过滤，None 表示探测失败（限流、5xx、网络错误），结果未知
+        """
+        host = urlparse(url).netloc
+        content_filter = self.config["content_filter"]
+        row = {"url": url, "status": None, "content_type": None, "length": None,
+               "width": None, "height": None, "accepted": None, "reason": None}
+        method = "GET" if self.config["discover"]["sniff_dimensions"] else "HEAD"
+        
+        async with self.scheduler.slot(host):
+            if not await self.breaker.allow(host):
+                row["reason"] = "circuit open"
+                return row
+            proxy, response_received = None, False
+            try:
+                while True:
+                    headers = self.config["headers"].copy()
+                    if method == "GET":
+                        headers["Range"] = f"bytes=0-{content_filter['sniff_bytes'] - 1}"
+                    await self.rate_limiter.acquire(host)
+                    proxy = await self.get_proxy()
+                    started = asyncio.get_running_loop().time()
+                    async with self.transport.request(
+                        method, url,
+                        headers=headers,
+                        proxy=proxy,
+                        proxy_auth=self.proxy_manager.auth
+                    ) as response:
+                        response_received = True
+                        elapsed = asyncio.get_running_loop().time() - started
+                        self.proxy_manager.report(proxy, True, elapsed)
+                        self.breaker.record(host, response.status < 500)
+                        # 与下载相同地反馈给自适应并发，探测也随主机的限流和延迟调整
+                        if response.status in (429, 503):
+                            self.scheduler.feedback(host, False)
+                            self.metrics.inc("throttled_total", host=host)
+                        elif response.status < 500:
+                            self.scheduler.feedback(host, True, elapsed)
+                        if method == "HEAD" and response.status in (405, 501):
+                            method = "GET"
+                            continue
+                        
+                        content_type = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+                        row.update(status=response.status, content_type=content_type or None,
+                                   length=self.response_length(response))
+                        if response.status in (429, 503):
+                            self.rate_limiter.throttled(host, response.headers.get("Retry-After"))
+                        if response.status >= 400:
+                            row["reason"] = f"HTTP {response.status}"
+                            if response.status < 500 and response.status not in (408, 429):
+                                row["accepted"] = False
+                            return row
+                        if content_type not in content_filter["content_types"]:
+                            row.update(accepted=False, reason="content type")
+                            return row
+                        
+                        if method == "GET" and content_type.startswith("image/"):
+                            sniffer = DimensionSniffer(
+                                content_filter["min_size"],
+                                content_filter["max_size"],
+                                content_filter["sniff_bytes"]
+                            )
+                            try:
+                                # 服务器忽略 Range 返回完整内容时，读到嗅探上限即断开
+                                async for chunk in response.content.iter_chunked(65536):
+                                    await self.rate_limiter.consume(host, len(chunk))
+                                    sniffer.feed(chunk)
+                                    if sniffer.done:
+                                        break
+                            except ImageDimensionRejected as e:
+                                row.update(accepted=False, reason=str(e))
+                            if sniffer.size is not None:
+                                row["width"], row["height"] = sniffer.size
+                            if row["accepted"] is False:
+                                return row
+                        row["accepted"] = True
+                        return row
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not response_received:
+                    self.proxy_manager.report(proxy, False)
+                    self.breaker.record(host, False)
+                if isinstance(e, asyncio.TimeoutError):
+                    self.scheduler.feedback(host, False)
+                row["reason"] = str(e) or type(e).__name__
+                return row
+    
+    @staticmethod
+    def response_length(response: aiohttp.ClientResponse) -> Optional[int]:
+        """资源的完整长度：范围响应取 Content-Range 中的总长度，否则取 Content-Length"""
+        if response.status == 206:
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            return int(total) if total.isdigit() else None
+        length = response.headers.get("Content-Length", "")
+        return int(length) if length.isdigit() else None
+    
+    async def fetch_page(self, url: str) -> Tuple[List[str], List[str]]:
+        """抓取单个页面，返回 (图片URL列表, 页面链接列表)"""
+        host = urlparse(url).netloc
+        await self.rate_limiter.acquire(host)
+        async with self.transport.request("GET", url) as response:
+            if response.status in (429, 503):
+                self.rate_limiter.throttled(host, response.headers.get("Retry-After"))
+            response.raise_for_status()
+            if "html" not in response.headers.get("Content-Type", "text/html"):
+                return [], []
+            html = await response.text()
+        
+        # 解析放到工作线程/进程中，避免阻塞事件循环上的下载
+        image_urls, link_urls = await asyncio.get_running_loop().run_in_executor(
+            self.parse_executor, extract_page_urls, html, url, self.parser
+        )
+        page_urls = []
+        for link_url in link_urls:
+            if not self.is_valid_url(link_url):
+                continue
+            if urlparse(link_url).path.lower().endswith(IMAGE_EXTENSIONS):
+                image_urls.append(link_url)
+            else:
+                page_urls.append(link_url)
+        return [u for u in image_urls if self.is_valid_url(u)], page_urls
     
     def is_valid_url(self, url: str) -> bool:
         """URL有效性检查"""
@@ -239,18 +3617,18 @@ class ImageDownloader:
         """运行程序"""
         try:
             self.setup_logging()
-            await self.crawl_images(start_url, output_folder)
+            async with self:
+                await self.crawl_images(start_url, output_folder)
         except Exception as e:
-            console.print(f"[red]Fatal error: {str(e)}[/red]")
+            error_console.print(f"[red]Fatal error: {str(e)}[/red]")
         finally:
-            await self.session.close()
-            self.conn.close()
             console.print("\n[bold]Download completed![/bold]")
     
     def setup_logging(self):
-        """配置日志系统"""
+        """配置日志系统：记录经队列交给后台线程写到终端和文件，事件循环上只做入队"""
         log_config = self.config["logging"]
         log_level = getattr(logging, log_config["level"].upper())
+        console_level = getattr(logging, log_config["console_level"].upper())
         
         log_dir = os.path.dirname(log_config["file"])
         os.makedirs(log_dir, exist_ok=True)
@@ -260,8 +3638,16 @@ class ImageDownloader:
             datefmt='%Y-%m-%d %H:%M:%S'
         )
         
-        console_handler = logging.StreamHandler(sys.stdout)
-        console_handler.setFormatter(formatter)
+        if log_config["quiet"]:
+            console.quiet = True
+            console_level = max(console_level, logging.ERROR)
+        # 经 rich 输出，进度条显示期间日志打印在进度条上方
+        console_handler = RichHandler(
+            console=error_console if log_config["quiet"] else console,
+            show_path=False,
+            log_time_format='%Y-%m-%d %H:%M:%S'
+        )
+        console_handler.setLevel(console_level)
         
         file_handler = TimedRotatingFileHandler(
             filename=log_config["file"],
@@ -271,27 +3657,62 @@ class ImageDownloader:
             encoding='utf-8'
         )
         file_handler.setFormatter(formatter)
+        file_handler.setLevel(log_level)
         
+        self.stop_logging()
+        self.log_listener = QueueListener(queue.SimpleQueue(), console_handler, file_handler,
+                                          respect_handler_level=True)
         root_logger = logging.getLogger()
-        root_logger.setLevel(log_level)
-        root_logger.addHandler(console_handler)
-        root_logger.addHandler(file_handler)
+        for handler in root_logger.handlers[:]:
+            if isinstance(handler, QueueHandler):
+                root_logger.removeHandler(handler)
+        root_logger.setLevel(min(log_level, console_level))
+        self.log_handler = QueueHandler(self.log_listener.queue)
+        root_logger.addHandler(self.log_handler)
+        self.log_listener.start()
         
         root_logger.info(f"Loaded config from {CONFIG_FILE}")
+    
+    def stop_logging(self):
+        """从根日志器移除队列处理器，停止后台日志线程并写完队列中剩余的记录"""
+        if self.log_handler is not None:
+            # 先移除再停止，之后的日志不会进入已无人消费的队列
+            logging.getLogger().removeHandler(self.log_handler)
+            self.log_handler = None
+        if self.log_listener is not None:
+            self.log_listener.stop()
+            for handler in self.log_listener.handlers:
+                handler.close()
+            self.log_listener = None
 
-    def load_config(self, path: str) -> dict:
-        """加载配置文件"""
+    def load_config(self, path: str, overrides: Optional[dict] = None) -> dict:
+        """加载配置文件，overrides（如命令行选项）优先于文件中的配置"""
         if not os.path.exists(path):
             self.save_config(DEFAULT_CONFIG, path)
             console.print(f"[yellow]Config file created: {path}[/yellow]")
-            return DEFAULT_CONFIG
+            user_config = {}
+        else:
+            with open(path, "r") as f:
+                user_config = json.load(f)
         
-        with open(path, "r") as f:
-            user_config = json.load(f)
+        # 旧配置文件缺少的配置项使用默认值（嵌套配置段逐层合并）
+        config = copy.deepcopy(DEFAULT_CONFIG)
+        for source in (user_config, overrides or {}):
+            self.merge_config(config, source)
         
         # 验证配置完整性
-        self.validate_config(user_config)
-        return user_config
+        self.validate_config(config)
+        config.setdefault("headers", {"User-Agent": config["user_agent"]})
+        return config
+    
+    @staticmethod
+    def merge_config(config: dict, source: dict):
+        """把 source 递归合并进 config，只覆盖 source 中出现的配置项"""
+        for key, value in source.items():
+            if isinstance(value, dict) and isinstance(config.get(key), dict):
+                ImageDownloader.merge_config(config[key], value)
+            else:
+                config[key] = copy.deepcopy(value)
     
     def validate_config(self, config: dict):
         """增强配置验证"""
@@ -302,6 +3723,215 @@ class ImageDownloader:
             "proxy_pool": {"type": str},
             "proxy_auth": {"type": str, "nullable": True},
             "proxy_country": {"type": str, "nullable": True},
+            "proxy_manager": {
+                "type": dict,
+                "schema": {
+                    "proxies": {"type": list, "schema": {"type": str}},
+                    "check_url": {"type": str},
+                    "check_timeout": {"type": (int, float), "min": 0},
+                    "check_concurrency": {"type": int, "min": 1},
+                    "refresh_interval": {"type": int, "min": 1},
+                    "retest_interval": {"type": int, "min": 1},
+                    "max_failures": {"type": int, "min": 1},
+                    "latency_alpha": {"type": float, "min": 0, "max": 1},
+                    "min_ready": {"type": int, "min": 1},
+                    "startup_timeout": {"type": (int, float), "min": 0}
+                }
+            },
+            "auto_resume": {"type": bool},
+            "conditional_recrawl": {"type": bool},
+            "resume": {
+                "type": dict,
+                "schema": {
+                    "checkpoint_bytes": {"type": int, "min": 65536}
+                }
+            },
+            "record_writer": {
+                "type": dict,
+                "schema": {
+                    "batch_size": {"type": int, "min": 1},
+                    "flush_interval": {"type": (int, float), "min": 0},
+                    "max_queue": {"type": int, "min": 1},
+                    "max_retries": {"type": int, "min": 0},
+                    "retry_delay": {"type": (int, float), "min": 0}
+                }
+            },
+            "dedup": {
+                "type": dict,
+                "schema": {
+                    "enabled": {"type": bool},
+                    "link": {"type": str, "allowed": ["hardlink", "reference"]}
+                }
+            },
+            "crawl": {
+                "type": dict,
+                "schema": {
+                    "max_depth": {"type": int, "min": 0},
+                    "max_pages": {"type": int, "min": 1},
+                    "same_domain": {"type": bool},
+                    "allow_domains": {"type": list, "schema": {"type": str}},
+                    "frontier_file": {"type": str},
+                    "checkpoint_interval": {"type": int, "min": 1},
+                    "bloom_capacity": {"type": int, "min": 1},
+                    "bloom_error_rate": {"type": float, "gt": 0, "lt": 1}
+                }
+            },
+            "image_compression": {
+                "type": dict,
+                "schema": {
+                    "format": {"type": str, "allowed": ["jpeg", "png", "webp"]},
+                    "quality": {"type": int, "min": 1, "max": 100},
+                    "lossless": {"type": bool}
+                }
+            },
+            "derivatives": {
+                "type": dict,
+                "schema": {
+                    "keep_original": {"type": bool},
+                    "sizes": {
+                        "type": list,
+                        "schema": {
+                            "type": dict,
+                            "schema": {
+                                "name": {"type": str},
+                                "max_size": {"type": list, "len": 2, "schema": {"type": int, "min": 1}},
+                                "format": {"type": str, "allowed": ["jpeg", "png", "webp"]},
+                                "quality": {"type": int, "min": 1, "max": 100}
+                            }
+                        }
+                    }
+                }
+            },
+            "transcode": {
+                "type": dict,
+                "schema": {
+                    "workers": {"type": int, "min": 0},
+                    "max_inline_bytes": {"type": int, "min": 0},
+                    "max_inflight_bytes": {"type": int, "min": 1048576}
+                }
+            },
+            "extractor": {
+                "type": dict,
+                "schema": {
+                    "parser": {"type": str, "allowed": ["auto", "lxml", "html.parser"]},
+                    "use_processes": {"type": bool},
+                    "workers": {"type": int, "min": 1}
+                }
+            },
+            "distributed": {
+                "type": dict,
+                "schema": {
+                    "backend": {"type": str, "allowed": ["redis", "memory"]},
+                    "redis_url": {"type": str},
+                    "queue_name": {"type": str},
+                    "shards": {"type": int, "min": 1},
+                    "visibility_timeout": {"type": int, "min": 1},
+                    "poll_interval": {"type": (int, float), "min": 0}
+                }
+            },
+            "metrics": {
+                "type": dict,
+                "schema": {
+                    "enabled": {"type": bool},
+                    "port": {"type": int, "min": 0, "max": 65535},
+                    "summary": {"type": bool}
+                }
+            },
+            "scheduler": {
+                "type": dict,
+                "schema": {
+                    "per_host_limit": {"type": int, "min": 1},
+                    "dns_cache_ttl": {"type": int, "min": 0},
+                    "keepalive_timeout": {"type": int, "min": 0},
+                    "adaptive": {
+                        "type": dict,
+                        "schema": {
+                            "enabled": {"type": bool},
+                            "initial_limit": {"type": int, "min": 1},
+                            "min_limit": {"type": int, "min": 1},
+                            "decrease_factor": {"type": float, "min": 0.1, "max": 0.9},
+                            "latency_factor": {"type": (int, float), "min": 0},
+                            "cooldown": {"type": (int, float), "min": 0}
+                        }
+                    }
+                }
+            },
+            "storage": {
+                "type": dict,
+                "schema": {
+                    "layout": {"type": str, "allowed": ["flat", "content", "pack"]},
+                    "shard_depth": {"type": int, "min": 1, "max": 4},
+                    "pack_size": {"type": int, "min": 1048576}
+                }
+            },
+            "writer": {
+                "type": dict,
+                "schema": {
+                    "min_chunk": {"type": int, "min": 4096},
+                    "max_chunk": {"type": int, "min": 4096},
+                    "preallocate": {"type": bool},
+                    "fsync": {"type": str, "allowed": ["off", "file", "batch"]},
+                    "fsync_interval": {"type": (int, float), "min": 0}
+                }
+            },
+            "transport": {
+                "type": dict,
+                "schema": {
+                    "backend": {"type": str, "allowed": ["aiohttp", "http2"]},
+                    "http2_prior_knowledge": {"type": bool}
+                }
+            },
+            "discover": {
+                "type": dict,
+                "schema": {
+                    "sniff_dimensions": {"type": bool}
+                }
+            },
+            "ingest": {
+                "type": dict,
+                "schema": {
+                    "format": {"type": str, "allowed": ["auto", "txt", "csv", "jsonl"]},
+                    "csv_column": {"type": str},
+                    "batch_size": {"type": int, "min": 1, "max": 900},
+                    "checkpoint_file": {"type": str},
+                    "checkpoint_interval": {"type": (int, float), "min": 0}
+                }
+            },
+            "pipeline": {
+                "type": dict,
+                "schema": {
+                    "queue_size": {"type": int, "min": 1},
+                    "transcode_queue_size": {"type": int, "min": 1},
+                    "transcode_workers": {"type": int, "min": 0}
+                }
+            },
+            "circuit_breaker": {
+                "type": dict,
+                "schema": {
+                    "enabled": {"type": bool},
+                    "failure_threshold": {"type": int, "min": 1},
+                    "cooldown": {"type": (int, float), "min": 0}
+                }
+            },
+            "rate_limit": {
+                "type": dict,
+                "schema": {
+                    "requests_per_second": {"type": (int, float), "min": 0},
+                    "burst": {"type": int, "min": 1},
+                    "bytes_per_second": {"type": int, "min": 0},
+                    "default_pause": {"type": (int, float), "min": 0},
+                    "max_retry_after": {"type": (int, float), "min": 0},
+                    "backoff_base": {"type": (int, float), "min": 0},
+                    "backoff_max": {"type": (int, float), "min": 0}
+                }
+            },
+            "state_store": {
+                "type": dict,
+                "schema": {
+                    "backend": {"type": str, "allowed": ["mysql", "sqlite"]},
+                    "sqlite_path": {"type": str}
+                }
+            },
             "db_config": {
                 "type": dict,
                 "schema": {
@@ -318,6 +3948,7 @@ class ImageDownloader:
                 "schema": {
                     "min_size": {"type": list, "len": 2, "schema": {"type": int, "min": 0}},
                     "max_size": {"type": list, "len": 2, "schema": {"type": int, "min": 0}},
+                    "sniff_bytes": {"type": int, "min": 1024},
                     "content_types": {"type": list, "schema": {"type": str}}
                 }
             },
@@ -325,9 +3956,12 @@ class ImageDownloader:
                 "type": dict,
                 "schema": {
                     "level": {"type": str, "allowed": ["DEBUG", "INFO", "WARNING", "ERROR"]},
+                    "console_level": {"type": str, "allowed": ["DEBUG", "INFO", "WARNING", "ERROR"]},
                     "file": {"type": str},
                     "backup_count": {"type": int, "min": 1},
-                    "max_bytes": {"type": int, "min": 1024}
+                    "max_bytes": {"type": int, "min": 1024},
+                    "progress_interval": {"type": (int, float), "min": 0.05},
+                    "quiet": {"type": bool}
                 }
             }
         }
@@ -339,39 +3973,142 @@ class ImageDownloader:
         with open(path, "w") as f:
             json.dump(config, f, indent=4, sort_keys=True)
     
-    async def load_proxy_pool(self):
-        """异步加载代理池"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    self.config["proxy_pool"],
-                    proxy=self.config.get("proxy_auth"),
-                    timeout=10
-                ) as response:
-                    if response.status == 200:
-                        return await response.text().splitlines()
-        except Exception as e:
-            console.print(f"[red]Proxy pool loading failed: {str(e)}[/red]")
-        return []
+    async def get_proxy(self) -> Optional[str]:
+        """获取可用代理（由后台健康检查维护，不做逐次探测）"""
+        with self.metrics.timer("proxy"):
+            return self.proxy_manager.pick()
+
+COMMANDS = ("crawl", "ingest", "discover", "coordinator", "worker")
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="异步图片下载器")
+    parser.add_argument("--config", default=CONFIG_FILE, help="配置文件路径")
+    parser.add_argument("--threads", type=int, help="全局并发下载数")
+    parser.add_argument("--max-retries", type=int, help="单张图片最大重试次数")
+    parser.add_argument("--timeout", type=int, help="请求超时时间（秒）")
+    parser.add_argument("--auto-resume", action="store_true", default=None, help="启用断点续传")
+    parser.add_argument("--proxy", help="代理地址，可多次指定", action="append")
+    parser.add_argument("--proxy-auth", help="代理认证（用户名:密码）")
+    parser.add_argument("--proxy-country", help="代理国家过滤（如 US）")
+    parser.add_argument("--compression-format", choices=["jpeg", "png", "webp"], help="输出格式")
+    parser.add_argument("--compression-quality", type=int, help="压缩质量（1-100）")
+    parser.add_argument("--lossless", action="store_true", default=None, help="WebP无损压缩")
+    parser.add_argument("--http2", action="store_true", default=None, help="使用 HTTP/2 传输（需要 httpx[http2]）")
+    parser.add_argument("--quiet", action="store_true", default=None, help="不显示进度和日志，只把错误输出到标准错误")
+    subparsers = parser.add_subparsers(dest="command")
     
-    async def get_proxy(self):
-        """获取可用代理"""
-        while self.proxy_pool:
-            proxy = self.proxy_pool.pop(0)
+    crawl = subparsers.add_parser("crawl", help="从起始页抓取并下载图片")
+    crawl.add_argument("url")
+    crawl.add_argument("folder", nargs="?", default="images")
+    
+    ingest = subparsers.add_parser("ingest", help="下载URL列表中的图片（文件或 - 表示标准输入）")
+    ingest.add_argument("input")
+    ingest.add_argument("folder", nargs="?", default="images")
+    ingest.add_argument("--format", choices=["auto", "txt", "csv", "jsonl"], help="输入格式，默认按扩展名判断")
+    ingest.add_argument("--column", help="CSV中URL所在的列名或列序号")
+    
+    discover = subparsers.add_parser("discover", help="抓取页面并只探测图片（不下载），输出可供 ingest 使用的 JSONL 清单")
+    discover.add_argument("url")
+    discover.add_argument("manifest", nargs="?", default="manifest.jsonl")
+    discover.add_argument("--head", action="store_true", help="只发 HEAD 请求，不读取图片头部获取尺寸")
+    
+    coordinator = subparsers.add_parser("coordinator", help="抓取页面，把图片URL放入分布式队列")
+    coordinator.add_argument("url")
+    
+    worker = subparsers.add_parser("worker", help="从分布式队列拉取并下载图片")
+    worker.add_argument("folder", nargs="?", default="images")
+    worker.add_argument("--index", type=int, default=0, help="本节点序号")
+    worker.add_argument("--count", type=int, default=1, help="节点总数")
+    
+    argv = sys.argv[1:] if argv is None else argv
+    # 兼容 python download_images.py [选项] [目标URL] [保存目录]：第一个位置参数不是子命令时补上 crawl
+    takes_value = {opt for action in parser._actions if action.nargs != 0 for opt in action.option_strings}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in takes_value:
+            # 跳过选项的取值（如 --proxy http://host:port）
+            i += 2
+        elif arg.startswith("-") and arg != "-":
+            i += 1
+        else:
+            if arg not in COMMANDS:
+                argv = argv[:i] + ["crawl"] + argv[i:]
+            break
+    return parser.parse_args(argv)
+
+def cli_overrides(args: argparse.Namespace) -> dict:
+    """命令行中显式给出的选项，覆盖配置文件"""
+    overrides = {
+        "threads": args.threads,
+        "max_retries": args.max_retries,
+        "timeout": args.timeout,
+        "auto_resume": args.auto_resume,
+        "proxy_auth": args.proxy_auth,
+        "proxy_country": args.proxy_country
+    }
+    sections = {
+        "proxy_manager": {"proxies": args.proxy},
+        "image_compression": {
+            "format": args.compression_format,
+            "quality": args.compression_quality,
+            "lossless": args.lossless
+        },
+        "logging": {"quiet": args.quiet},
+        "transport": {"backend": "http2" if args.http2 else None}
+    }
+    if args.command == "ingest":
+        sections["ingest"] = {"csv_column": args.column}
+    if args.command == "discover" and args.head:
+        sections["discover"] = {"sniff_dimensions": False}
+    overrides = {key: value for key, value in overrides.items() if value is not None}
+    for section, values in sections.items():
+        values = {key: value for key, value in values.items() if value is not None}
+        if values:
+            overrides[section] = values
+    return overrides
+
+async def run_command(args: argparse.Namespace):
+    downloader = ImageDownloader(args.config, cli_overrides(args))
+    downloader.setup_logging()
+    async with downloader:
+        if args.command == "crawl":
+            await downloader.crawl_images(args.url, args.folder)
+        elif args.command == "ingest":
+            await downloader.ingest_urls(args.input, args.folder, args.format)
+        elif args.command == "discover":
+            await downloader.discover(args.url, args.manifest)
+        elif args.command == "coordinator":
+            queue = create_job_queue(downloader.config, shared=True)
             try:
-                async with self.session.get(
-                    "https://www.google.com",
-                    proxy=proxy,
-                    timeout=5
-                ) as response:
-                    if response.status == 200:
-                        return proxy
-            except Exception as e:
-                console.print(f"[yellow]Proxy invalid: {str(e)}[/yellow]")
-        return None
+                await downloader.run_coordinator(args.url, queue)
+            finally:
+                await queue.close()
+        elif args.command == "worker":
+            queue = create_job_queue(downloader.config, shared=True)
+            try:
+                await downloader.run_worker(queue, args.folder, args.index, args.count)
+            finally:
+                await queue.close()
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    if args.command is None:
+        # 交互模式
+        args.command = "crawl"
+        args.url = console.input("[bold]Start URL: [/bold]").strip()
+        args.folder = console.input("[bold]Output folder [images]: [/bold]").strip() or "images"
+    try:
+        asyncio.run(run_command(args))
+    except KeyboardInterrupt:
+        console.print("\n[yellow]Interrupted, progress saved[/yellow]")
+        sys.exit(130)
+    except Exception as e:
+        error_console.print(f"[red]Fatal error: {str(e)}[/red]")
+        sys.exit(1)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
 
 # 需要安装的依赖包：
 # pip install aiohttp aiomysql beautifulsoup4 Pillow rich sqlalchemy
@@ -0,0 +1,169 @@
+import asyncio
+
+import pytest
+
+import download_images
+from download_images import MemoryJobQueue, RedisJobQueue, create_job_queue
+
+URLS = [f"https://example.com/{i}.jpg" for i in range(20)]
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class FakeClock:
+    """替换 time.time，按需推进时间以触发可见性超时"""
+    
+    def __init__(self):
+        self.now = 1_000_000.0
+    
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(download_images.time, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "redis"])
+def make_queue(request, monkeypatch):
+    """按后端创建队列；redis 后端使用 fakeredis（需要 lupa 执行 Lua 脚本）"""
+    if request.param == "memory":
+        return lambda shards=4, visibility_timeout=30: MemoryJobQueue(shards, visibility_timeout)
+    
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    if download_images.aioredis is None:
+        pytest.skip("redis is not installed")
+    monkeypatch.setattr(download_images.aioredis, "from_url",
+                        lambda url, **kwargs: fakeredis.aioredis.FakeRedis(**kwargs))
+    return lambda shards=4, visibility_timeout=30: RedisJobQueue("redis://fake", "test", shards, visibility_timeout)
+
+
+async def drain(queue, shards):
+    jobs = []
+    while True:
+        job = await queue.get(shards)
+        if job is None:
+            return jobs
+        jobs.append(job)
+
+
+def test_each_url_is_delivered_once(make_queue, clock):
+    async def scenario():
+        queue = make_queue()
+        await queue.put(URLS)
+        jobs = await drain(queue, list(range(queue.shards)))
+        assert sorted(queue.url_of(job) for job in jobs) == sorted(URLS)
+        for job in jobs:
+            assert int(job.split("|", 1)[0]) == queue.shard_of(queue.url_of(job))
+        await queue.close()
+    
+    run(scenario())
+
+
+def test_worker_only_sees_its_shards(make_queue, clock):
+    async def scenario():
+        queue = make_queue()
+        await queue.put(URLS)
+        jobs = await drain(queue, [0, 2])
+        assert {queue.url_of(job) for job in jobs} == {url for url in URLS if queue.shard_of(url) in (0, 2)}
+        await queue.close()
+    
+    run(scenario())
+
+
+def test_unacked_job_is_requeued_after_visibility_timeout(make_queue, clock):
+    async def scenario():
+        queue = make_queue(visibility_timeout=30)
+        await queue.put(URLS[:1])
+        shards = list(range(queue.shards))
+        job = await queue.get(shards)
+        assert job is not None
+        
+        # 超时之前既不能重新入队，也不能被其他消费者取到
+        clock.now += 29
+        assert await queue.requeue_expired() == 0
+        assert await queue.get(shards) is None
+        
+        clock.now += 2
+        assert await queue.requeue_expired() == 1
+        again = await queue.get(shards)
+        assert again is not None and queue.url_of(again) == URLS[0]
+        await queue.close()
+    
+    run(scenario())
+
+
+def test_acked_job_is_not_requeued(make_queue, clock):
+    async def scenario():
+        queue = make_queue(visibility_timeout=30)
+        await queue.put(URLS[:3])
+        shards = list(range(queue.shards))
+        for job in await drain(queue, shards):
+            await queue.ack(job)
+        clock.now += 60
+        assert await queue.requeue_expired() == 0
+        assert await queue.get(shards) is None
+        await queue.close()
+    
+    run(scenario())
+
+
+def test_drained_only_after_finished_and_all_acked(make_queue, clock):
+    async def scenario():
+        queue = make_queue()
+        shards = list(range(queue.shards))
+        assert not await queue.is_drained()
+        
+        await queue.put(URLS[:2])
+        await queue.mark_finished()
+        assert not await queue.is_drained()
+        
+        jobs = await drain(queue, shards)
+        # 任务已取出但未确认，仍未完成
+        assert not await queue.is_drained()
+        for job in jobs:
+            await queue.ack(job)
+        assert await queue.is_drained()
+        await queue.close()
+    
+    run(scenario())
+
+
+def test_reset_clears_finished_flag(make_queue, clock):
+    async def scenario():
+        queue = make_queue()
+        shards = list(range(queue.shards))
+        await queue.put(URLS[:2])
+        job = await queue.get(shards)
+        await queue.mark_finished()
+        
+        await queue.reset(keep_jobs=True)
+        assert not await queue.is_drained()
+        clock.now += 60
+        assert await queue.requeue_expired() == 1
+        assert len(await drain(queue, shards)) == 2
+        
+        await queue.put(URLS[2:4])
+        await queue.mark_finished()
+        await queue.reset()
+        assert await queue.get(shards) is None
+        assert await queue.requeue_expired() == 0
+        assert not await queue.is_drained()
+        await queue.mark_finished()
+        assert await queue.is_drained()
+        await queue.close()
+    
+    run(scenario())
+
+
+def test_memory_backend_cannot_be_shared():
+    config = {"distributed": {"backend": "memory", "shards": 4, "visibility_timeout": 30}}
+    assert isinstance(create_job_queue(config), MemoryJobQueue)
+    with pytest.raises(ValueError):
+        create_job_queue(config, shared=True)
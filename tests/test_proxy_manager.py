@@ -0,0 +1,173 @@
+import asyncio
+import copy
+import random
+import socket
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from download_images import DEFAULT_CONFIG, ProxyManager
+
+CHECK_URL = "http://check.invalid/"
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class ProxyStub:
+    """本地 HTTP 代理桩：收到任何请求都按 healthy 返回 200 或 503，并记录请求的目标URL"""
+    
+    def __init__(self):
+        self.healthy = True
+        self.requests = []
+        app = web.Application()
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        self.server = TestServer(app, host="127.0.0.1")
+    
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests.append(str(request.url))
+        return web.Response(status=200 if self.healthy else 503, text="ok")
+    
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.port}"
+    
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+    
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+
+def closed_port_url() -> str:
+    """一个没有监听者的本地地址，连接会被立即拒绝"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+
+def make_manager(proxies, **settings) -> ProxyManager:
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    config["proxy_pool"] = ""
+    config["proxy_auth"] = None
+    config["proxy_manager"].update({
+        "proxies": proxies,
+        "check_url": CHECK_URL,
+        "check_timeout": 2,
+        "refresh_interval": 3600,
+        "retest_interval": 3600,
+        "max_failures": 2,
+        # 默认等首次检查全部结束，结果确定
+        "min_ready": len(proxies) + 1,
+        "startup_timeout": 10
+    })
+    config["proxy_manager"].update(settings)
+    return ProxyManager(config)
+
+
+def test_health_check_keeps_working_proxies_and_quarantines_the_rest():
+    async def scenario():
+        async with ProxyStub() as good, ProxyStub() as bad:
+            bad.healthy = False
+            dead = closed_port_url()
+            manager = make_manager([good.url, bad.url, dead])
+            await manager.start()
+            try:
+                assert set(manager.active) == {good.url}
+                assert set(manager.quarantine) == {bad.url, dead}
+                # 检查请求经代理发往检查地址
+                assert good.requests and good.requests[0].startswith(CHECK_URL)
+                assert manager.pick() == good.url
+            finally:
+                await manager.close()
+    
+    run(scenario())
+
+
+def test_start_returns_once_min_ready_proxies_pass():
+    async def scenario():
+        async with ProxyStub() as good:
+            manager = make_manager([good.url], min_ready=1)
+            await manager.start()
+            try:
+                assert list(manager.active) == [good.url]
+            finally:
+                await manager.close()
+    
+    run(scenario())
+
+
+def test_repeated_failures_quarantine_a_proxy():
+    async def scenario():
+        async with ProxyStub() as first, ProxyStub() as second:
+            manager = make_manager([first.url, second.url], max_failures=2)
+            await manager.start()
+            try:
+                manager.report(first.url, False)
+                assert first.url in manager.active
+                # 成功会清零连续失败次数
+                manager.report(first.url, True, 0.1)
+                manager.report(first.url, False)
+                assert first.url in manager.active
+                manager.report(first.url, False)
+                assert first.url not in manager.active
+                assert first.url in manager.quarantine
+                assert all(manager.pick() == second.url for _ in range(50))
+            finally:
+                await manager.close()
+    
+    run(scenario())
+
+
+def test_quarantined_proxy_recovers_after_retest():
+    async def scenario():
+        async with ProxyStub() as stub:
+            stub.healthy = False
+            manager = make_manager([stub.url], retest_interval=0.05)
+            await manager.start()
+            try:
+                assert manager.pick() is None
+                assert stub.url in manager.quarantine
+                stub.healthy = True
+                for _ in range(100):
+                    if stub.url in manager.active:
+                        break
+                    await asyncio.sleep(0.05)
+                assert stub.url in manager.active
+                assert stub.url not in manager.quarantine
+                assert manager.pick() == stub.url
+            finally:
+                await manager.close()
+    
+    run(scenario())
+
+
+def test_pick_prefers_fast_reliable_proxies():
+    async def scenario():
+        async with ProxyStub() as fast, ProxyStub() as slow:
+            manager = make_manager([fast.url, slow.url])
+            await manager.start()
+            try:
+                manager.active[fast.url].latency = 0.05
+                manager.active[slow.url].latency = 0.5
+                random.seed(1)
+                picks = [manager.pick() for _ in range(2000)]
+                # 得分约 10:1
+                assert picks.count(fast.url) > 5 * picks.count(slow.url) > 0
+                
+                # 失败率高的代理权重下降
+                manager.active[slow.url].latency = 0.05
+                for _ in range(20):
+                    manager.report(slow.url, True, 0.05)
+                    manager.report(slow.url, False)
+                    manager.report(slow.url, True, 0.05)
+                    manager.report(fast.url, True, 0.05)
+                picks = [manager.pick() for _ in range(2000)]
+                assert picks.count(fast.url) > picks.count(slow.url)
+            finally:
+                await manager.close()
+    
+    run(scenario())